@@ -15,24 +15,59 @@ CREATE TABLE accounts (
   id VARCHAR (50) PRIMARY KEY,
   balance INTEGER NOT NULL
 );
+CREATE TABLE applied_run (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL,
+  requests TEXT,
+  transfers TEXT,
+  configurations TEXT
+);
 \c bank2
 CREATE TABLE accounts (
   id VARCHAR (50) PRIMARY KEY,
   balance INTEGER NOT NULL
 );
+CREATE TABLE applied_run (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL,
+  requests TEXT,
+  transfers TEXT,
+  configurations TEXT
+);
 \c bank3
 CREATE TABLE accounts (
   id VARCHAR (50) PRIMARY KEY,
   balance INTEGER NOT NULL
 );
+CREATE TABLE applied_run (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL,
+  requests TEXT,
+  transfers TEXT,
+  configurations TEXT
+);
 \c bank4
 CREATE TABLE accounts (
   id VARCHAR (50) PRIMARY KEY,
   balance INTEGER NOT NULL
 );
+CREATE TABLE applied_run (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL,
+  requests TEXT,
+  transfers TEXT,
+  configurations TEXT
+);
 \c bank5
 CREATE TABLE accounts (
   id VARCHAR (50) PRIMARY KEY,
   balance INTEGER NOT NULL
 );
+CREATE TABLE applied_run (
+  id INTEGER PRIMARY KEY,
+  run_id INTEGER NOT NULL,
+  requests TEXT,
+  transfers TEXT,
+  configurations TEXT
+);
 
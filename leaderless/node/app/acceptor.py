@@ -1,85 +1,355 @@
-import pickle
+import os
+import sys
 import logging
+import pickle
+import threading
 from collections import defaultdict
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Request, Response
 from pydantic import BaseModel
 
 import bank as bank
+import logs as logs
+import wire as wire
+from cluster import FAST_PROPOSE_ID, GROUPS, proposer_of
+from wal import WriteAheadLog
+from workers import ThreadLimiter
 
-FILE_NAME = "acceptor.pickle"
+FILE_NAME = "acceptor"
+# State file of acceptors from before the write-ahead log, turned into the first snapshot on upgrade.
+LEGACY_FILE_NAME = "acceptor.pickle"
+# Number of WAL records after which the whole state is snapshotted and the log truncated.
+SNAPSHOT_EVERY = int(os.environ.get("ACCEPTOR_SNAPSHOT_EVERY", 1000))
+# Maximum time a state change waits for concurrent ones to be persisted with the same fsync.
+GROUP_COMMIT_DELAY_MS = float(os.environ.get("ACCEPTOR_GROUP_COMMIT_DELAY_MS", 0))
+# Compaction runs once the low-water mark moved by at least this many runs.
+GC_EVERY = int(os.environ.get("ACCEPTOR_GC_EVERY", 100))
+# Threads handling acceptor messages. They are not shared with client requests, so that peers
+# are answered while local clients wait for consensus.
+THREADS = int(os.environ.get("ACCEPTOR_THREADS", 16))
 
-logger = logging.getLogger('ACCEPTOR')
-logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler('acceptor.log')
-fh.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s:    %(name)s:    %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
+logger = logs.get_logger('ACCEPTOR', 'acceptor.log')
 
 
 def create_default_params():
+    # Run state of acceptors from before the write-ahead log, needed to unpickle LEGACY_FILE_NAME.
     return {"promised_id": -1, "accepted_id": -1, "accepted_val": None}
 
 
-class Acceptor:
+class RunState:
+    """
+    Acceptor state of a single run. Accepted values are kept in the compact BankBatch.to_tuple() form.
+    """
+    __slots__ = ("promised_id", "accepted_id", "accepted_val")
+
     def __init__(self):
+        self.promised_id = -1
+        self.accepted_id = -1
+        self.accepted_val = None
+
+    def __getstate__(self):
+        return self.promised_id, self.accepted_id, self.accepted_val
+
+    def __setstate__(self, state):
+        self.promised_id, self.accepted_id, self.accepted_val = state
+
+    def __repr__(self) -> str:
+        return f"{{promised_id: {self.promised_id}, accepted_id: {self.accepted_id}, accepted_val: {self.accepted_val}}}"
+
+
+class Acceptor:
+    def __init__(self, group: int = 0):
         """
-        Instantiates an Acceptor object from the on-disk file iff there is one available.
+        Instantiates the Acceptor of a group from the on-disk snapshot and write-ahead log iff they are available.
+        """
+        self.group = group
+        self.parameters = defaultdict(RunState)
+        # Promise granted over every run_id >= range_from_run_id (Multi-Paxos).
+        self.range_from_run_id = None
+        self.range_promised_id = -1
+        # Runs below the low-water mark were applied by every node and have been compacted away.
+        self.low_water_mark = 0
+        # Number of runs every node has applied and checkpointed, as reported in its messages.
+        self.node_run_ids = {}
+
+        self.lock = threading.Lock()
+        # Group 0 keeps the file names from before groups were introduced.
+        name = FILE_NAME if group == 0 else f"{FILE_NAME}-{group}"
+        self.wal = WriteAheadLog(name, SNAPSHOT_EVERY, GROUP_COMMIT_DELAY_MS / 1000)
+        snapshot, records = self.wal.recover()
+        if snapshot is None and not records:
+            snapshot = self.load_legacy()
+        if snapshot is not None:
+            self.parameters.update(snapshot["parameters"])
+            self.range_from_run_id = snapshot["range_from_run_id"]
+            self.range_promised_id = snapshot["range_promised_id"]
+            self.low_water_mark = snapshot["low_water_mark"]
+            self.node_run_ids = snapshot["node_run_ids"]
+        for record in records:
+            self.apply(record)
+
+        if snapshot is None and not records:
+            logger.debug('No Acceptor object found on the disk! Creating a new one.')
+        else:
+            logger.debug('Instantiated Acceptor object from a snapshot and %s log records.', len(records))
+
+    def load_legacy(self):
+        """
+        Returns the state pickled by an acceptor from before the write-ahead log, after persisting it
+        as the first snapshot, or None if there is none.
         """
         try:
-            with open(FILE_NAME, "rb") as infile:
+            with open(LEGACY_FILE_NAME, "rb") as infile:
                 on_disk_acceptor = pickle.load(infile)
-                self.parameters = on_disk_acceptor.parameters
-                logger.debug('Instantiated Acceptor object from a file.')
-
         except FileNotFoundError:
-            self.parameters = defaultdict(create_default_params)
-            logger.debug('No Acceptor object found on the disk! Creating a new one.')
+            return None
+        parameters = {}
+        for run_id, params in on_disk_acceptor.parameters.items():
+            run_parameters = parameters[run_id] = RunState()
+            run_parameters.promised_id = params["promised_id"]
+            run_parameters.accepted_id = params["accepted_id"]
+            op = params["accepted_val"]
+            if op is not None:
+                # Values used to be single operations, they become batches of one.
+                run_parameters.accepted_val = ((op.node_id, int(op.op_type), tuple(op.args.items())),)
+        snapshot = {
+            "parameters": parameters,
+            "range_from_run_id": getattr(on_disk_acceptor, "range_from_run_id", None),
+            "range_promised_id": getattr(on_disk_acceptor, "range_promised_id", -1),
+            "low_water_mark": 0,
+            "node_run_ids": {},
+        }
+        self.wal.snapshot(snapshot)
+        logger.debug('Converted %s into the first snapshot.', LEGACY_FILE_NAME)
+        return snapshot
+
+    def log(self, run_id: int, propose_id: int, state, message: str, *args):
+        # The state is mutated after the call, so it is rendered here rather than by the log writer.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message, *args, extra={"group": self.group if GROUPS > 1 else None, "run_id": run_id,
+                                                "propose_id": propose_id,
+                                                "acceptor_state": None if state is None else str(state)})
+
+    def apply(self, record: tuple):
+        """
+        Applies a state change described by a WAL record. Used both when handling messages and on recovery.
+        """
+        match record:
+            case ("promise", run_id, propose_id):
+                if run_id >= self.low_water_mark:
+                    run_parameters = self.parameters[run_id]
+                    run_parameters.promised_id = max(run_parameters.promised_id, propose_id)
+            case ("range_promise", run_id, propose_id):
+                self.range_promised_id = max(self.range_promised_id, propose_id)
+                if self.range_from_run_id is None or run_id < self.range_from_run_id:
+                    self.range_from_run_id = run_id
+            case ("accept", run_id, propose_id, val):
+                if run_id >= self.low_water_mark:
+                    run_parameters = self.parameters[run_id]
+                    run_parameters.accepted_id = propose_id
+                    run_parameters.accepted_val = val
+            case ("gc", low_water_mark, node_run_ids):
+                self.node_run_ids = dict(node_run_ids)
+                for run_id in range(self.low_water_mark, low_water_mark):
+                    self.parameters.pop(run_id, None)
+                self.low_water_mark = max(self.low_water_mark, low_water_mark)
+            case _:
+                raise ValueError(f"Unrecognised WAL record {record}!")
+
+    def persist(self, record: tuple):
+        """
+        Applies the state change and appends it to the log. It becomes durable with the next group commit.
+        """
+        self.apply(record)
+        self.wal.append(record)
+        if self.wal.should_snapshot():
+            self.wal.snapshot(self.state())
+
+    def handle(self, body, handler, *args, durable: bool = True):
+        """
+        Runs a message handler under the acceptor lock. The result is returned only once every state change
+        it could have observed is durable, so no reply ever reveals state that a crash could lose.
+        Callers passing durable=False have to wait for the log themselves before replying.
+        """
+        with self.lock:
+            self.observe(body.node_id, body.applied_run_id)
+            res = handler(*args)
+            seq = self.wal.written_seq
+        if durable:
+            self.wal.wait_durable(seq)
+        return res
+
+    def state(self) -> dict:
+        return {
+            "parameters": dict(self.parameters),
+            "range_from_run_id": self.range_from_run_id,
+            "range_promised_id": self.range_promised_id,
+            "low_water_mark": self.low_water_mark,
+            "node_run_ids": self.node_run_ids,
+        }
 
-    def log(self, run_id: int, propose_id: int, state: dict, message: str):
-        logger.debug(f"[RUN: {run_id}] [PROPOSE_ID: {propose_id}] [ACCEPTOR_STATE: {state}]:    {message}")
+    def observe(self, node_id: int, run_id: int):
+        """
+        Records that node_id has durably applied every run before run_id and compacts runs applied by all nodes
+        that are members of the configurations of the runs kept.
+        """
+        if node_id is None or run_id is None or run_id <= self.node_run_ids.get(node_id, 0):
+            return
+        self.node_run_ids[node_id] = run_id
+
+        members = bank.tables[self.group].configurations.members_from(self.low_water_mark)
+        if any(id not in self.node_run_ids for id in members):
+            return
+        low_water_mark = min(self.node_run_ids[id] for id in members)
+        if low_water_mark - self.low_water_mark >= GC_EVERY:
+            logger.debug("Compacting runs [%s, %s).", self.low_water_mark, low_water_mark)
+            self.persist(("gc", low_water_mark, tuple(self.node_run_ids.items())))
+
+    def promised_id(self, run_id) -> int:
+        """
+        Returns the highest propose id promised for the run, taking the range promise into account.
+        """
+        promised_id = self.parameters[run_id].promised_id
+        if self.range_from_run_id is not None and run_id >= self.range_from_run_id:
+            return max(promised_id, self.range_promised_id)
+        return promised_id
+
+    def accepted_val(self, run_parameters: RunState):
+        if run_parameters.accepted_val is None:
+            return None
+        return bank.BankBatch.from_tuple(run_parameters.accepted_val)
 
     def handle_prepare(self, run_id, propose_id):
+        if run_id < self.low_water_mark:
+            self.log(run_id, propose_id, None, 'Ignoring request for a compacted run.')
+            return None, self.range_promised_id
+
         run_parameters = self.parameters[run_id]
 
-        if run_parameters["promised_id"] < propose_id:
-            self.log(run_id, propose_id, run_parameters, f'Promised to ignore propose id <= {propose_id}.')
+        if self.promised_id(run_id) < propose_id:
+            self.log(run_id, propose_id, run_parameters, 'Promised to ignore propose id <= %s.', propose_id)
+
+            self.persist(("promise", run_id, propose_id))
+            return run_parameters.accepted_id, self.accepted_val(run_parameters)
 
-            run_parameters["promised_id"] = propose_id
-            return run_parameters["accepted_id"], run_parameters["accepted_val"]
+        self.log(run_id, propose_id, run_parameters, 'Ignoring request.')
+        return None, self.promised_id(run_id)
+
+    def handle_prepare_range(self, run_id, propose_id):
+        """
+        Promises to ignore propose ids <= propose_id for every run >= run_id.
+        Returns all values accepted in those runs, so that the proposer can re-propose them.
+        """
+        promised_id = max([self.range_promised_id] +
+                          [params.promised_id for id, params in self.parameters.items() if id >= run_id])
 
-        self.log(run_id, propose_id, run_parameters, f'Ignoring request.')
-        return None, run_parameters["promised_id"]
+        if promised_id < propose_id:
+            self.log(run_id, propose_id, {"range_promised_id": promised_id},
+                     "Promised to ignore propose id <= %s for runs >= %s.", propose_id, run_id)
+
+            self.persist(("range_promise", run_id, propose_id))
+            accepted = [{"run_id": id, "accepted_id": params.accepted_id, "accepted_val": self.accepted_val(params)}
+                        for id, params in self.parameters.items()
+                        if id >= run_id and params.accepted_val is not None]
+            return accepted, None
+
+        self.log(run_id, propose_id, {"range_promised_id": promised_id}, 'Ignoring request.')
+        return None, promised_id
 
     def handle_accept(self, run_id, propose_id, val):
+        if run_id < self.low_water_mark:
+            self.log(run_id, propose_id, None, 'Ignoring request for a compacted run.')
+            return False
+
         run_parameters = self.parameters[run_id]
+        val = bank.as_batch(val).to_tuple()
 
-        if run_parameters["promised_id"] <= propose_id:
-            run_parameters["accepted_id"] = propose_id
-            run_parameters["accepted_val"] = val
-            self.log(run_id, propose_id, run_parameters, f'Accepted value {val}.')
+        if propose_id == FAST_PROPOSE_ID and run_parameters.accepted_val is not None:
+            # In the fast round an acceptor only votes for the first value it receives.
+            accepted = run_parameters.accepted_id == FAST_PROPOSE_ID and run_parameters.accepted_val == val
+            self.log(run_id, propose_id, run_parameters, 'Fast round value %s.',
+                     "accepted again" if accepted else "ignored, another value was accepted")
+            return accepted
+
+        if self.promised_id(run_id) <= propose_id:
+            self.persist(("accept", run_id, propose_id, val))
+            self.log(run_id, propose_id, run_parameters, 'Accepted value %s.', val)
             return True
 
-        self.log(run_id, propose_id, run_parameters, f'Ignoring request.')
+        self.log(run_id, propose_id, run_parameters, 'Ignoring request.')
         return False
 
-    def serialize(self):
-        with open(FILE_NAME, "wb") as outfile:
-            pickle.dump(self, outfile)
+    def handle_read_index(self) -> int:
+        """
+        Returns the highest run in which a value may have been chosen with this acceptor's vote.
+        """
+        accepted = [run_id for run_id, params in self.parameters.items() if params.accepted_val is not None]
+        return max(accepted + [self.low_water_mark - 1])
+
+    def footprint(self) -> dict:
+        with self.lock:
+            runs = list(self.parameters.items())
+            low_water_mark = self.low_water_mark
+            node_run_ids = dict(self.node_run_ids)
+        size = sys.getsizeof(self.parameters)
+        for run_id, params in runs:
+            size += sys.getsizeof(run_id) + sys.getsizeof(params)
+            if params.accepted_val is not None:
+                size += sys.getsizeof(params.accepted_val)
+                for op in params.accepted_val:
+                    size += sys.getsizeof(op) + sys.getsizeof(op[2])
+        return {
+            "low_water_mark": low_water_mark,
+            "runs": len(runs),
+            "approx_bytes": size,
+            "wal_bytes": os.path.getsize(self.wal.log_path),
+            "node_run_ids": node_run_ids,
+        }
 
 
 class PrepareMessage(BaseModel):
     run_id: int = None
     propose_id: int = None
+    # Multi-Paxos: ask for a promise covering every run >= run_id.
+    range_prepare: bool = False
+    node_id: int = None
+    applied_run_id: int = None
+    group: int = 0
 
-    def __init__(self, run_id: int, propose_id: int):
+    def __init__(self, run_id: int, propose_id: int, range_prepare: bool = False, node_id: int = None,
+                 applied_run_id: int = None, group: int = 0):
         super().__init__()
         self.run_id = run_id
         self.propose_id = propose_id
+        self.range_prepare = range_prepare
+        self.node_id = node_id
+        self.applied_run_id = applied_run_id
+        self.group = group
+
+    def to_wire(self) -> tuple:
+        return (wire.PREPARE, self.group, self.run_id, self.propose_id, self.range_prepare, self.node_id,
+                self.applied_run_id)
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class AppliedMessage(BaseModel):
+    """
+    Reports that the node has applied every run before applied_run_id. Nodes send it periodically,
+    so that runs are compacted while some of them do not propose.
+    """
+    node_id: int = None
+    applied_run_id: int = None
+    group: int = 0
+
+    def __init__(self, node_id: int, applied_run_id: int, group: int = 0):
+        super().__init__()
+        self.node_id = node_id
+        self.applied_run_id = applied_run_id
+        self.group = group
+
+    def to_wire(self) -> tuple:
+        return wire.APPLIED, self.group, self.node_id, self.applied_run_id
 
     def __str__(self) -> str:
         return self.__repr__()
@@ -88,37 +358,145 @@ class PrepareMessage(BaseModel):
 class AcceptMessage(BaseModel):
     run_id: int = None
     propose_id: int = None
-    val: bank.BankOperation = None
+    val: bank.BankBatch = None
+    node_id: int = None
+    applied_run_id: int = None
+    group: int = 0
 
-    def __init__(self, run_id: int, propose_id: int, val: bank.BankOperation):
+    def __init__(self, run_id: int, propose_id: int, val: bank.BankBatch, node_id: int = None,
+                 applied_run_id: int = None, group: int = 0):
         super().__init__()
         self.run_id = run_id
         self.propose_id = propose_id
         self.val = val
+        self.node_id = node_id
+        self.applied_run_id = applied_run_id
+        self.group = group
+
+    def to_wire(self) -> tuple:
+        return wire.ACCEPT, self.group, self.run_id, self.propose_id, self.val, self.node_id, self.applied_run_id
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class ReadIndexMessage(BaseModel):
+    node_id: int = None
+    applied_run_id: int = None
+    group: int = 0
+
+    def __init__(self, node_id: int = None, applied_run_id: int = None, group: int = 0):
+        super().__init__()
+        self.node_id = node_id
+        self.applied_run_id = applied_run_id
+        self.group = group
+
+    def to_wire(self) -> tuple:
+        return wire.READ_INDEX, self.group, self.node_id, self.applied_run_id
 
     def __str__(self) -> str:
         return self.__repr__()
 
 
 router = APIRouter()
-instance = Acceptor()
+instances = [Acceptor(group) for group in range(GROUPS)]
+threads = ThreadLimiter("acceptor_threads", THREADS)
 
 
-@router.put("/acceptor_prepare")
-def acceptor_prepare(body: PrepareMessage):
-    logger.debug(f"Received {body}")
-    res = instance.handle_prepare(body.run_id, body.propose_id)
-    instance.serialize()
+def instance_of(group: int) -> Acceptor:
+    if not 0 <= group < len(instances):
+        raise HTTPException(status_code=404, detail="Group not found.")
+    return instances[group]
+
+
+def prepare(body: PrepareMessage, durable: bool = True) -> dict:
+    logger.debug("Received %s", body)
+    instance = instance_of(body.group)
+    if body.range_prepare:
+        res = instance.handle(body, instance.handle_prepare_range, body.run_id, body.propose_id, durable=durable)
+        if res[0] is not None:
+            return {"accepted": res[0]}
+        return {"promised_id": res[1], "promised_by": proposer_of(res[1])}
+
+    res = instance.handle(body, instance.handle_prepare, body.run_id, body.propose_id, durable=durable)
     if res[0] is not None:
         # Prepare operation succeeded!
         return {"accepted_id": res[0], "accepted_val": res[1]}
-    # Prepare operation did not succeed, send NACK response.
-    return {"promised_id": res[1]}
+    # Prepare operation did not succeed, send NACK response naming the proposer we promised to.
+    return {"promised_id": res[1], "promised_by": proposer_of(res[1])}
 
 
-@router.put("/acceptor_accept")
-def acceptor_accept(body: AcceptMessage):
-    logger.debug(f"Received {body}")
-    res = instance.handle_accept(body.run_id, body.propose_id, body.val)
-    instance.serialize()
+def accept(body: AcceptMessage, durable: bool = True) -> dict:
+    logger.debug("Received %s", body)
+    instance = instance_of(body.group)
+    res = instance.handle(body, instance.handle_accept, body.run_id, body.propose_id, body.val, durable=durable)
     return {"accepted": res}
+
+
+def applied(body: AppliedMessage, durable: bool = True) -> dict:
+    logger.debug("Received %s", body)
+    instance = instance_of(body.group)
+    instance.handle(body, lambda: None, durable=durable)
+    return {}
+
+
+def read_index(body: ReadIndexMessage, durable: bool = True) -> dict:
+    logger.debug("Received %s", body)
+    instance = instance_of(body.group)
+    return {"run_id": instance.handle(body, instance.handle_read_index, durable=durable)}
+
+
+def handle_batch(data: bytes) -> bytes:
+    """
+    Handles wire encoded messages in order and replies once the state changes of all of them are durable.
+    """
+    responses = []
+    groups = set()
+    for message in wire.decode_requests(data):
+        match message:
+            case (wire.PREPARE, group, run_id, propose_id, range_prepare, node_id, applied_run_id):
+                responses.append(prepare(PrepareMessage(run_id, propose_id, range_prepare, node_id, applied_run_id,
+                                                        group), durable=False))
+            case (wire.ACCEPT, group, run_id, propose_id, val, node_id, applied_run_id):
+                responses.append(accept(AcceptMessage(run_id, propose_id, val, node_id, applied_run_id, group),
+                                        durable=False))
+            case (wire.READ_INDEX, group, node_id, applied_run_id):
+                responses.append(read_index(ReadIndexMessage(node_id, applied_run_id, group), durable=False))
+            case (wire.APPLIED, group, node_id, applied_run_id):
+                responses.append(applied(AppliedMessage(node_id, applied_run_id, group), durable=False))
+        groups.add(group)
+    for group in groups:
+        wal = instances[group].wal
+        wal.wait_durable(wal.written_seq)
+    return wire.encode_responses(responses)
+
+
+@router.put("/acceptor_prepare")
+async def acceptor_prepare(body: PrepareMessage):
+    return await threads.run(prepare, body)
+
+
+@router.put("/acceptor_accept")
+async def acceptor_accept(body: AcceptMessage):
+    return await threads.run(accept, body)
+
+
+@router.put("/acceptor_read_index")
+async def acceptor_read_index(body: ReadIndexMessage):
+    return await threads.run(read_index, body)
+
+
+@router.put("/acceptor_applied")
+async def acceptor_applied(body: AppliedMessage):
+    return await threads.run(applied, body)
+
+
+@router.put("/acceptor_batch")
+async def acceptor_batch(request: Request):
+    data = await request.body()
+    return Response(content=await threads.run(handle_batch, data), media_type="application/octet-stream")
+
+
+@router.get("/acceptor_stats")
+def acceptor_stats(group: int = 0):
+    return instance_of(group).footprint()
@@ -1,118 +1,435 @@
+import json
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
 from enum import IntEnum
+from typing import List
 
 from fastapi import HTTPException
 from pydantic import BaseModel
 
-from database import *
+import logs as logs
+from cluster import GROUPS, group_of
+from configuration import WINDOW, Configuration, History
+from storage import open_storage
 
 NODE_ID = os.environ["NODE_ID"]
-db = connect()
-db.autocommit = False
+# Interval at which changes of the in-memory account table are written to the storage backend.
+CHECKPOINT_INTERVAL_MS = float(os.environ.get("BANK_CHECKPOINT_INTERVAL_MS", 1000))
+# State files that held the applied run before the checkpoint did, newest first, read once on upgrade.
+LEGACY_FILE_NAMES = ["learner.pickle", "proposer.pickle"]
+# Number of changed accounts after which a checkpoint starts before the interval ends, e.g. while catching up.
+CHECKPOINT_MAX_DIRTY = int(os.environ.get("BANK_CHECKPOINT_MAX_DIRTY", 10000))
+# Number of most recently applied client requests whose results every node keeps, so that a request decided
+# again, e.g. after a retry on another node, is applied once.
+DEDUP_SIZE = int(os.environ.get("BANK_DEDUP_SIZE", 10000))
+# Number of cross-group transfer steps every group remembers, so that a step decided twice is applied once.
+TRANSFER_DEDUP_SIZE = int(os.environ.get("BANK_TRANSFER_DEDUP_SIZE", 10000))
+
+logger = logs.get_logger('BANK', 'bank.log')
+
+storage = open_storage()
+# Guards the account table, which is shared by the threads applying and validating operations.
+lock = threading.Lock()
+checkpoint_requested = threading.Event()
 
 class BankOpType(IntEnum):
     OPEN_ACCOUNT = 1
     DEPOSIT = 2
     WITHDRAW = 3
     TRANSFER = 4
+    # Steps of a transfer between accounts of different groups: the source group debits the account and
+    # records the transfer as outgoing, the destination group credits the other account, then the source
+    # group forgets the transfer.
+    TRANSFER_OUT = 5
+    TRANSFER_IN = 6
+    TRANSFER_DONE = 7
+    # Changes the nodes deciding the runs of the group, see configuration.WINDOW.
+    RECONFIGURE = 8
+
+# Operations that never debit an account. Applying them cannot fail for insufficient funds and leaves
+# the same balances in any order, so batches made of them only may be merged and decided together.
+COMMUTATIVE = {BankOpType.OPEN_ACCOUNT, BankOpType.DEPOSIT, BankOpType.TRANSFER_IN, BankOpType.TRANSFER_DONE}
 
 
 class BankOperation(BaseModel):
     node_id: int = NODE_ID
     op_type: BankOpType = None
     args: dict = {}
+    # Identifies the client request, retries of the request carry the same id.
+    request_id: str = None
 
-    def __init__(self, op_type, args: dict, node_id: int = NODE_ID) -> None:
+    def __init__(self, op_type, args: dict, node_id: int = NODE_ID, request_id: str = None) -> None:
         super().__init__()
         self.op_type = op_type
         self.args = args
-        self.node_id = node_id
+        self.node_id = int(node_id)
+        self.request_id = request_id if request_id is not None else uuid.uuid4().hex
 
     def __eq__(self, other):
         return isinstance(other, BankOperation) and self.dict() == other.dict()
 
+    def to_tuple(self) -> tuple:
+        """
+        Compact representation used to keep accepted values in memory and in the acceptor log.
+        """
+        return self.node_id, int(self.op_type), tuple(self.args.items()), self.request_id
+
+    @staticmethod
+    def from_tuple(val: tuple) -> "BankOperation":
+        # Operations logged before request ids were introduced get a new one.
+        node_id, op_type, args, *request_id = val
+        return BankOperation(op_type=BankOpType(op_type), args=dict(args), node_id=node_id,
+                             request_id=request_id[0] if request_id else None)
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+class BankBatch(BaseModel):
+    """
+    Value decided in a single run: client operations applied in order. An empty batch is a no-op.
+    """
+    ops: List[BankOperation] = []
+
+    def __init__(self, ops: list) -> None:
+        super().__init__()
+        self.ops = ops
+
+    def __eq__(self, other):
+        return isinstance(other, BankBatch) and self.dict() == other.dict()
+
+    def to_tuple(self) -> tuple:
+        return tuple(op.to_tuple() for op in self.ops)
+
+    @staticmethod
+    def from_tuple(val: tuple) -> "BankBatch":
+        return BankBatch(ops=[BankOperation.from_tuple(op) for op in val])
+
     def __str__(self) -> str:
         return self.__repr__()
 
 
-def get_account_with_id(cur, id: str):
-    account = read_query(cur, "SELECT * FROM accounts WHERE id = \'{}\';".format(id))
-    if len(account) == 0:
-        db.rollback()
+def as_operation(val) -> BankOperation:
+    """
+    Accepted values come back as BankOperation objects from the local acceptor and as dicts from peers.
+    """
+    if isinstance(val, BankOperation):
+        return val
+    return BankOperation(**val)
+
+
+def as_batch(val) -> BankBatch:
+    if isinstance(val, BankBatch):
+        return val
+    return BankBatch(ops=[as_operation(op) for op in val["ops"]])
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """
+    Reads proposer.pickle, in which the first proposers pickled themselves, without importing the proposer.
+    """
+
+    class OnDiskProposer:
+        pass
+
+    def find_class(self, module, name):
+        if (module, name) == ("proposer", "Proposer"):
+            return self.OnDiskProposer
+        return super().find_class(module, name)
+
+
+def load_legacy_run_id() -> int:
+    """
+    Returns the applied run recorded by nodes from before checkpoints, whose database was always up to date.
+    """
+    for file_name in LEGACY_FILE_NAMES:
+        try:
+            with open(file_name, "rb") as infile:
+                on_disk = LegacyUnpickler(infile).load()
+        except FileNotFoundError:
+            continue
+        if not isinstance(on_disk, dict):
+            on_disk = vars(on_disk)
+        logger.debug("Took the applied run %s over from %s.", on_disk["run_id"], file_name)
+        return on_disk["run_id"]
+    return 0
+
+
+def commutes(batch: BankBatch) -> bool:
+    """
+    Returns whether the batch only holds commutative operations, which commute with any other such batch.
+    """
+    return all(op.op_type in COMMUTATIVE for op in batch.ops)
+
+
+def merge_batches(*batches) -> BankBatch:
+    """
+    Returns the operations of all the batches, every request once, in the order in which they first appear.
+    """
+    ops = {}
+    for batch in batches:
+        for op in as_batch(batch).ops:
+            ops.setdefault(op.request_id, op)
+    return BankBatch(ops=list(ops.values()))
+
+
+class AccountTable:
+    """
+    Authoritative applied state of a group: balances of its accounts after applying every run of the group
+    before run_id. The storage backend only holds a checkpoint of it, which is rebuilt into memory on start.
+    """
+
+    def __init__(self, group: int):
+        self.group = group
+        self.balances = {}
+        self.run_id = 0
+        # Results (or errors) of the last DEDUP_SIZE operations applied in this group by request id, oldest first.
+        self.requests = OrderedDict()
+        # Cross-group transfers debited in this group and not completed yet, transfer id -> (to_id, amount),
+        # and the last TRANSFER_DEDUP_SIZE transfer steps applied in this group, e.g. "in:<transfer id>".
+        self.outgoing = {}
+        self.applied_steps = OrderedDict()
+        # Nodes deciding the runs of the group.
+        self.configurations = History()
+        # Accounts changed and removed since the last checkpoint.
+        self.dirty = set()
+        self.deleted = set()
+        self.checkpoint_run_id = 0
+
+    def load(self):
+        accounts, run = storage.load(self.group)
+        self.balances = {id: balance for id, balance in accounts if group_of(id) == self.group}
+        # Group 0 holds the accounts of nodes from before checkpoints.
+        self.run_id = run[0] if run else load_legacy_run_id() if self.group == 0 else 0
+        if run and run[1] is not None:
+            self.restore_requests(json.loads(run[1]))
+        if run and run[2] is not None:
+            self.restore_transfers(json.loads(run[2]))
+        if run and run[3] is not None:
+            self.configurations = History.from_list(json.loads(run[3]))
+        self.checkpoint_run_id = self.run_id
+        logger.debug("Loaded %s accounts of group %s applied up to run %s from the checkpoint.",
+                     len(self.balances), self.group, self.run_id)
+
+    def dump_transfers(self) -> dict:
+        return {"outgoing": self.outgoing, "applied_steps": list(self.applied_steps)}
+
+    def restore_transfers(self, transfers: dict):
+        self.outgoing = {id: tuple(transfer) for id, transfer in transfers["outgoing"].items()}
+        self.applied_steps = OrderedDict.fromkeys(transfers["applied_steps"])
+
+    def remember(self, request_id: str, res):
+        self.requests[request_id] = res
+        while len(self.requests) > DEDUP_SIZE:
+            self.requests.popitem(last=False)
+
+    def dump_requests(self) -> list:
+        # Failed operations are kept as their status code and detail.
+        return [(id, {"error": [res.status_code, res.detail]} if isinstance(res, HTTPException) else res)
+                for id, res in self.requests.items()]
+
+    def restore_requests(self, requests: list):
+        self.requests = OrderedDict((id, HTTPException(*res["error"]) if "error" in res else res)
+                                    for id, res in requests)
+
+    def checkpoint(self):
+        """
+        Writes the accounts changed since the last checkpoint, together with run_id, the results of recent
+        requests, pending transfers and configurations, in a single transaction.
+        """
+        with lock:
+            if not self.dirty and not self.deleted and self.run_id == self.checkpoint_run_id:
+                return
+            ids = list(self.dirty)
+            balances = [self.balances[id] for id in ids]
+            deleted = list(self.deleted)
+            transfers = json.dumps(self.dump_transfers())
+            configurations = json.dumps(self.configurations.to_list())
+            run_id = self.run_id
+            requests = json.dumps(self.dump_requests())
+            self.dirty = set()
+            self.deleted = set()
+
+        try:
+            storage.save(self.group, run_id, ids, balances, deleted, requests, transfers, configurations)
+        except Exception as error:
+            logger.debug("Checkpoint of run %s of group %s failed. Reason: %s", run_id, self.group, error)
+            with lock:
+                # A snapshot installed meanwhile may have replaced the accounts.
+                self.dirty.update(id for id in ids if id in self.balances)
+                self.deleted.update(id for id in deleted if id not in self.balances)
+            return
+
+        with lock:
+            self.checkpoint_run_id = run_id
+        logger.debug("Checkpointed %s accounts of group %s applied up to run %s.", len(ids), self.group, run_id)
+
+
+def checkpointer():
+    while True:
+        checkpoint_requested.wait(CHECKPOINT_INTERVAL_MS / 1000)
+        checkpoint_requested.clear()
+        for table in tables:
+            table.checkpoint()
+
+
+def table_of(id: str) -> AccountTable:
+    return tables[group_of(id)]
+
+
+def mark_dirty(id: str):
+    table = table_of(id)
+    table.dirty.add(id)
+    if len(table.dirty) >= CHECKPOINT_MAX_DIRTY:
+        checkpoint_requested.set()
+
+
+def get_account_with_id(id: str):
+    table = table_of(id)
+    if id not in table.balances:
         raise HTTPException(status_code=404, detail="Account not found.")
-    return {"id": id, "balance": account[0][1]}
+    return {"id": id, "balance": table.balances[id]}
 
 
-def set_funds(cur, account):
+def set_funds(account):
     if account["balance"] < 0:
-        db.rollback()
         raise HTTPException(status_code=403, detail="Not sufficient funds.")
-    write_query(cur, "UPDATE accounts SET balance = {} WHERE id = \'{}\';" \
-                .format(account["balance"], account["id"]))
+    table_of(account["id"]).balances[account["id"]] = account["balance"]
+    mark_dirty(account["id"])
 
 
-def open_bank_account(id: int):
-    with db.cursor() as cur:
-        write_query(cur, "INSERT INTO accounts(id, balance) VALUES (\'{}\', 0);".format(id))
-        db.commit()
+def open_bank_account(id: str):
+    table_of(id).balances[id] = 0
+    mark_dirty(id)
     return {"id": id, "balance": 0}
 
 
 def deposit_funds(id: str, amount: int):
-    with db.cursor() as cur:
-        account = get_account_with_id(cur, id)
-        account["balance"] += amount
-        set_funds(cur, account)
-        db.commit()
+    account = get_account_with_id(id)
+    account["balance"] += amount
+    set_funds(account)
     return account
 
 
 def withdraw_funds(id: str, amount: int):
-    with db.cursor() as cur:
-        account = get_account_with_id(cur, id)
-        account["balance"] -= amount
-        set_funds(cur, account)
-        db.commit()
+    account = get_account_with_id(id)
+    account["balance"] -= amount
+    set_funds(account)
     return account
 
 
 def transfer_funds(to_id: str, from_id: str, amount: int):
-    with db.cursor() as cur:
-        account_from = get_account_with_id(cur, from_id)
-        account_from["balance"] -= amount
-        account_to = get_account_with_id(cur, to_id)
-        account_to["balance"] += amount
-        set_funds(cur, account_from)
-        set_funds(cur, account_to)
-        db.commit()
+    account_from = get_account_with_id(from_id)
+    account_from["balance"] -= amount
+    account_to = get_account_with_id(to_id)
+    account_to["balance"] += amount
+    set_funds(account_from)
+    set_funds(account_to)
     return {"account_from": account_from, "account_to": account_to}
 
 
+def applied_step(table: AccountTable, step: str):
+    """
+    Records the transfer step as applied in the group. Beyond TRANSFER_DEDUP_SIZE steps the oldest ones are
+    forgotten, except the debits of transfers still outgoing, which recovery may decide again.
+    """
+    table.applied_steps[step] = None
+    excess = len(table.applied_steps) - TRANSFER_DEDUP_SIZE
+    if excess <= 0:
+        return
+    evicted = []
+    for old in table.applied_steps:
+        if len(evicted) == excess or old == step:
+            break
+        if not (old.startswith("out:") and old[len("out:"):] in table.outgoing):
+            evicted.append(old)
+    for old in evicted:
+        del table.applied_steps[old]
+
+
+def transfer_out(from_id: str, to_id: str, amount: int, transfer_id: str):
+    table = table_of(from_id)
+    if f"out:{transfer_id}" in table.applied_steps:
+        return get_account_with_id(from_id)
+    account = withdraw_funds(from_id, amount)
+    table.outgoing[transfer_id] = (to_id, amount)
+    applied_step(table, f"out:{transfer_id}")
+    return account
+
+
+def transfer_in(to_id: str, amount: int, transfer_id: str):
+    table = table_of(to_id)
+    if f"in:{transfer_id}" in table.applied_steps:
+        return get_account_with_id(to_id)
+    # The step is only recorded once the credit succeeded, so that a failed credit can be decided again.
+    account = deposit_funds(to_id, amount)
+    applied_step(table, f"in:{transfer_id}")
+    return account
+
+
+def transfer_done(transfer_id: str, group: int):
+    tables[group].outgoing.pop(transfer_id, None)
+    return {}
+
+
+def reconfigure(group: int, members: str, phase1_quorum: int, phase2_quorum: int):
+    """
+    Decides the configuration of the runs of the group from WINDOW runs after the one being applied.
+    """
+    table = tables[group]
+    config = parse_configuration(members, phase1_quorum, phase2_quorum)
+    table.configurations.add(table.run_id + WINDOW, config, table.run_id)
+    return {"run_id": table.run_id + WINDOW, "configuration": config.to_dict()}
+
+
+def parse_configuration(members: str, phase1_quorum: int, phase2_quorum: int) -> Configuration:
+    """
+    members is a JSON object {node id: address}, operation arguments are strings or integers only.
+    """
+    try:
+        config = Configuration(json.loads(members), phase1_quorum, phase2_quorum)
+        config.validate()
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return config
+
+
 def validate_deposit_funds(id: str, amount: int):
-    with db.cursor() as cur:
-        get_account_with_id(cur, id)
-        db.rollback()
+    get_account_with_id(id)
 
 
 def validate_withdraw_funds(id: str, amount: int):
-    with db.cursor() as cur:
-        account = get_account_with_id(cur, id)
-        if account["balance"] < amount:
-            db.rollback()
-            raise HTTPException(status_code=403, detail="Insufficient funds.")
-        db.rollback()
+    account = get_account_with_id(id)
+    if account["balance"] < amount:
+        raise HTTPException(status_code=403, detail="Insufficient funds.")
 
 
 def validate_transfer_funds(to_id: str, from_id: str, amount: int):
-    with db.cursor() as cur:
-        account_from = get_account_with_id(cur, from_id)
-        if account_from["balance"] < amount:
-            db.rollback()
-            raise HTTPException(status_code=403, detail="Insufficient funds.")
-        get_account_with_id(cur, to_id)
-        db.rollback()
+    account_from = get_account_with_id(from_id)
+    if account_from["balance"] < amount:
+        raise HTTPException(status_code=403, detail="Insufficient funds.")
+    get_account_with_id(to_id)
+
 
+def account_ids(op: BankOperation) -> list:
+    """
+    Returns the ids of the accounts the operation reads or changes.
+    """
+    if op.op_type == BankOpType.TRANSFER_OUT:
+        # The credited account belongs to another group.
+        return [op.args["from_id"]]
+    return [op.args[key] for key in ("id", "from_id", "to_id") if key in op.args]
 
-def execute(op: BankOperation, op_seq_num: id) -> dict:
+
+def execute(op: BankOperation, op_seq_num: str, group: int = 0) -> dict:
+    """
+    Applies the operation in the group. Has to be called under lock.
+    """
+    if any(group_of(id) != group for id in account_ids(op)):
+        raise HTTPException(status_code=400, detail="Account belongs to another group.")
     match op.op_type:
         case BankOpType.OPEN_ACCOUNT:
             return open_bank_account(op_seq_num)
@@ -122,19 +439,134 @@ def execute(op: BankOperation, op_seq_num: id) -> dict:
             return withdraw_funds(**op.args)
         case BankOpType.TRANSFER:
             return transfer_funds(**op.args)
+        case BankOpType.TRANSFER_OUT:
+            return transfer_out(**op.args)
+        case BankOpType.TRANSFER_IN:
+            return transfer_in(**op.args)
+        case BankOpType.TRANSFER_DONE:
+            return transfer_done(op.args["transfer_id"], group)
+        case BankOpType.RECONFIGURE:
+            return reconfigure(group, op.args["members"], op.args["phase1_quorum"], op.args["phase2_quorum"])
         case _:
             raise ValueError("Operation type unrecognised!")
 
 
 def validate_without_executing(op: BankOperation):
-    match op.op_type:
-        case BankOpType.OPEN_ACCOUNT:
-            return
-        case BankOpType.DEPOSIT:
-            return validate_deposit_funds(**op.args)
-        case BankOpType.WITHDRAW:
-            return validate_withdraw_funds(**op.args)
-        case BankOpType.TRANSFER:
-            return validate_transfer_funds(**op.args)
-        case _:
-            raise ValueError("Operation type unrecognised!")
+    with lock:
+        match op.op_type:
+            case BankOpType.OPEN_ACCOUNT:
+                return
+            case BankOpType.DEPOSIT:
+                return validate_deposit_funds(**op.args)
+            case BankOpType.WITHDRAW:
+                return validate_withdraw_funds(**op.args)
+            case BankOpType.TRANSFER:
+                return validate_transfer_funds(**op.args)
+            case BankOpType.TRANSFER_OUT:
+                if f"out:{op.args['transfer_id']}" not in table_of(op.args["from_id"]).applied_steps:
+                    validate_withdraw_funds(op.args["from_id"], op.args["amount"])
+                return
+            case BankOpType.TRANSFER_IN:
+                get_account_with_id(op.args["to_id"])
+                return
+            case BankOpType.TRANSFER_DONE:
+                return
+            case BankOpType.RECONFIGURE:
+                parse_configuration(op.args["members"], op.args["phase1_quorum"], op.args["phase2_quorum"])
+                return
+            case _:
+                raise ValueError("Operation type unrecognised!")
+
+
+def execute_batch(batch: BankBatch, run_id: int, group: int = 0) -> list:
+    """
+    Applies the operations of a batch decided in the group in order. Returns a result or an HTTPException
+    for every operation, failed operations leave the bank unchanged. Operations of requests applied before
+    are skipped.
+    """
+    # Ids of opened accounts name the group, except in group 0 whose ids predate groups.
+    suffix = f".{group}" if group else ""
+    results = []
+    # A checkpoint only ever sees the state between two batches, together with the run it was applied up to.
+    table = tables[group]
+    with lock:
+        for i, op in enumerate(batch.ops):
+            if op.request_id in table.requests:
+                # The request was already decided in an earlier run, it is answered with the result it got there.
+                results.append(table.requests[op.request_id])
+                continue
+            try:
+                res = execute(op, f"{run_id}-{i}{suffix}", group)
+            except HTTPException as error:
+                res = error
+            table.remember(op.request_id, res)
+            results.append(res)
+        table.run_id = run_id + 1
+    return results
+
+
+def validate_batch(batch: BankBatch, group: int = 0) -> dict:
+    """
+    Validates every operation of the batch against the current state. Returns {index: HTTPException} of invalid ones.
+    """
+    errors = {}
+    for i, op in enumerate(batch.ops):
+        if applied_result(op.request_id, group)[0]:
+            continue
+        try:
+            validate_without_executing(op)
+        except HTTPException as error:
+            errors[i] = error
+    return errors
+
+
+def applied_result(request_id: str, group: int = 0) -> tuple:
+    """
+    Returns whether the request was recently applied in the group and its result (or error).
+    """
+    with lock:
+        table = tables[group]
+        if request_id in table.requests:
+            return True, table.requests[request_id]
+        return False, None
+
+
+def get_accounts(ids: list) -> list:
+    with lock:
+        return [get_account_with_id(id) for id in ids]
+
+
+def dump_accounts(group: int = 0) -> tuple:
+    """
+    Returns the whole state of the group: a list of (id, balance), the results of recent requests, its pending
+    transfers and its configurations.
+    """
+    with lock:
+        table = tables[group]
+        return (list(table.balances.items()), table.dump_requests(), table.dump_transfers(),
+                table.configurations.to_list())
+
+
+def restore_accounts(accounts: list, run_id: int, group: int = 0, requests: list = (), transfers: dict = None,
+                     configurations: list = None):
+    """
+    Replaces the whole state of the group with accounts, a list of (id, balance), applied up to run_id.
+    """
+    with lock:
+        table = tables[group]
+        balances = dict(accounts)
+        table.deleted.update(id for id in table.balances if id not in balances)
+        table.deleted.difference_update(balances)
+        table.balances = balances
+        table.dirty = set(balances)
+        table.run_id = run_id
+        table.restore_requests(requests)
+        table.restore_transfers(transfers or {"outgoing": {}, "applied_steps": []})
+        if configurations is not None:
+            table.configurations = History.from_list(configurations)
+
+
+tables = [AccountTable(group) for group in range(GROUPS)]
+for table in tables:
+    table.load()
+threading.Thread(target=checkpointer, name="checkpointer", daemon=True).start()
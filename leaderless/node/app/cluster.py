@@ -0,0 +1,53 @@
+import os
+import zlib
+
+# Comma separated host:port addresses of the nodes, node i being the i-th one. Without it there are
+# NODES nodes reached as node1:80, node2:80, ... Nodes added by reconfigurations are added to ADDRESSES.
+PEERS = os.environ.get("PEERS")
+if PEERS:
+    ADDRESSES = {id: address.strip() for id, address in enumerate(PEERS.split(","), start=1)}
+else:
+    ADDRESSES = {id: f"node{id}:80" for id in range(1, int(os.environ.get("NODES", 5)) + 1)}
+# Upper bound on node ids, also of nodes added later. Every node only uses propose ids congruent to its
+# NODE_ID modulo MAX_NODES, so it has to be the same on all nodes.
+MAX_NODES = int(os.environ.get("MAX_NODES", 16))
+NODE_ID = int(os.environ["NODE_ID"])
+if not 1 <= NODE_ID <= MAX_NODES:
+    raise ValueError(f"NODE_ID {NODE_ID} is not between 1 and MAX_NODES {MAX_NODES}!")
+
+# Every run starts with a fast round in which proposers skip PREPARE. No proposer uses its propose id in
+# later rounds, node ids start at 1.
+FAST_PROPOSE_ID = 0
+
+
+def proposer_of(propose_id: int) -> int:
+    """
+    Returns the node using the propose id. Returns None for -1, which is promised before any propose id.
+    """
+    if propose_id < 0:
+        return None
+    return (propose_id - 1) % MAX_NODES + 1
+
+
+# Number of independent consensus groups the accounts are partitioned into. Every group has its own log
+# of runs, acceptor state and proposer. The number of groups may grow, but never shrink. It is read from
+# PAXOS_GROUPS, bash sets GROUPS to the groups of the current user.
+GROUPS = int(os.environ.get("PAXOS_GROUPS", 1))
+
+
+def group_of(account_id: str) -> int:
+    """
+    Returns the group owning the account. Accounts opened by group g > 0 have ids ending in .g,
+    any other id belongs to group 0.
+    """
+    _, separator, group = account_id.rpartition(".")
+    if separator and group.isdigit() and int(group) < GROUPS:
+        return int(group)
+    return 0
+
+
+def group_of_request(request_id: str) -> int:
+    """
+    Returns the group a new account is opened in, new accounts are spread over the groups by request id.
+    """
+    return zlib.crc32(request_id.encode()) % GROUPS
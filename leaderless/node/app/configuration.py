@@ -0,0 +1,135 @@
+import os
+
+from cluster import ADDRESSES, MAX_NODES
+
+# Number of runs after the run deciding a reconfiguration in which the previous configuration stays in effect.
+# A proposer only starts a run once every run at least WINDOW runs before it has been applied, so that it knows
+# the configuration the run is decided in. This also bounds the number of runs in flight.
+WINDOW = int(os.environ.get("RECONFIGURATION_WINDOW", 64))
+
+# When enabled, batches of commutative operations (see bank.COMMUTATIVE) are first sent straight to the
+# acceptors in the fast round of their run and are decided in a single round trip by a fast quorum of them.
+# Commutative batches of proposers colliding in the fast round are merged and decided together.
+FAST_PATH = os.environ.get("FAST_PATH", "0") == "1"
+
+
+class Configuration:
+    """
+    Nodes whose acceptors decide runs, {node id: address}, and the quorums they decide them with.
+    """
+
+    def __init__(self, members: dict, phase1_quorum: int = None, phase2_quorum: int = None):
+        self.members = {int(id): address for id, address in members.items()}
+        majority = len(self.members) // 2 + 1
+        # Acceptors a proposer needs promises from (Phase 1) and votes from (Phase 2), a majority by default.
+        self.phase1_quorum = phase1_quorum or majority
+        self.phase2_quorum = phase2_quorum or majority
+
+    @property
+    def nodes(self) -> int:
+        return len(self.members)
+
+    @property
+    def read_quorum(self) -> int:
+        """
+        Acceptors asked for a read index, any such set includes a vote of every value chosen in Phase 2
+        or, with FAST_PATH, in the fast round.
+        """
+        quorum = min(self.phase2_quorum, self.fast_quorum) if FAST_PATH else self.phase2_quorum
+        return self.nodes - quorum + 1
+
+    @property
+    def fast_quorum(self) -> int:
+        """
+        Votes choosing a value in the fast round, any two fast quorums and a Phase 1 quorum intersect.
+        """
+        return (2 * self.nodes - self.phase1_quorum) // 2 + 1
+
+    def validate(self):
+        """
+        Raises ValueError unless node ids are valid and any Phase 1 quorum intersects any Phase 2 quorum.
+        """
+        if not self.members or any(not 1 <= id <= MAX_NODES for id in self.members):
+            raise ValueError(f"Members {list(self.members)} are not between 1 and MAX_NODES {MAX_NODES}!")
+        if not (0 < self.phase1_quorum <= self.nodes and 0 < self.phase2_quorum <= self.nodes and
+                self.phase1_quorum + self.phase2_quorum > self.nodes):
+            raise ValueError(f"Phase 1 quorum {self.phase1_quorum} and Phase 2 quorum {self.phase2_quorum} "
+                             f"do not intersect in a cluster of {self.nodes} nodes!")
+
+    def to_dict(self) -> dict:
+        return {"members": self.members, "phase1_quorum": self.phase1_quorum, "phase2_quorum": self.phase2_quorum}
+
+    @staticmethod
+    def from_dict(val: dict) -> "Configuration":
+        return Configuration(val["members"], val["phase1_quorum"], val["phase2_quorum"])
+
+    def __eq__(self, other):
+        return isinstance(other, Configuration) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"Configuration({self.to_dict()})"
+
+
+class History:
+    """
+    Configurations of the runs of a group: (first run, configuration) in run order, from the one in effect
+    for the next run to apply to the ones decided but not in effect yet. Entries are replaced, never
+    mutated, so readers do not need the bank lock.
+    """
+
+    def __init__(self, entries: list = None):
+        self.entries = tuple(entries) if entries else ((0, INITIAL),)
+
+    def at(self, run_id: int) -> Configuration:
+        """
+        Returns the configuration of the run, None for runs before the oldest configuration kept, which were applied.
+        """
+        config = None
+        for from_run_id, entry in self.entries:
+            if from_run_id <= run_id:
+                config = entry
+        return config
+
+    def latest(self) -> Configuration:
+        return self.entries[-1][1]
+
+    def configurations_from(self, run_id: int) -> list:
+        """
+        Returns the configurations the run or any later one is decided in.
+        """
+        configs = [self.at(run_id)] + [config for from_run_id, config in self.entries if from_run_id > run_id]
+        return [config for config in configs if config is not None]
+
+    def members_from(self, run_id: int) -> set:
+        """
+        Returns the nodes deciding the run or any later one.
+        """
+        return {id for config in self.configurations_from(run_id) for id in config.members}
+
+    def add(self, from_run_id: int, config: Configuration, run_id: int):
+        """
+        Records the configuration of runs >= from_run_id, decided in run_id, and forgets the ones no longer in effect.
+        """
+        ADDRESSES.update(config.members)
+        entries = [(id, entry) for id, entry in self.entries if id < from_run_id] + [(from_run_id, config)]
+        while len(entries) > 1 and entries[1][0] <= run_id:
+            entries.pop(0)
+        self.entries = tuple(entries)
+
+    def to_list(self) -> list:
+        return [(from_run_id, config.to_dict()) for from_run_id, config in self.entries]
+
+    @staticmethod
+    def from_list(val: list) -> "History":
+        history = History([(from_run_id, Configuration.from_dict(config)) for from_run_id, config in val])
+        for _, config in history.entries:
+            ADDRESSES.update(config.members)
+        return history
+
+
+# Configuration of the nodes listed in MEMBERS, e.g. "1,2,3", or of all the nodes in ADDRESSES, used until
+# the first reconfiguration. A node joining later is started with the MEMBERS of the cluster it joins.
+MEMBERS = os.environ.get("MEMBERS")
+INITIAL = Configuration({id: ADDRESSES[int(id)] for id in MEMBERS.split(",")} if MEMBERS else ADDRESSES,
+                        int(os.environ.get("PHASE1_QUORUM", 0)), int(os.environ.get("PHASE2_QUORUM", 0)))
+INITIAL.validate()
@@ -1,26 +1,96 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import os
+import threading
+from contextlib import contextmanager
 
 from config import config
 
-def connect():
-    """ Connect to the PostgreSQL database server """
-    try:
-        # read connection parameters
-        params = config()
-
-        if "NODE_ID" in os.environ:
-          params["database"] += os.environ["NODE_ID"]
-        
-        # connect to the PostgreSQL server
-        print('Connecting to the PostgreSQL database...')
-        return psycopg2.connect(**params)
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+# Maximum number of connections a node keeps open to its database.
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+
+
+def connection_params():
+    # read connection parameters
+    params = config()
+
+    if "NODE_ID" in os.environ:
+      params["database"] += os.environ["NODE_ID"]
+    return params
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # Whether the pool's on_connect hook already ran for this connection.
+    initialized = False
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of at most size database connections. Callers wait for a free connection.
+    Connections are checked before being handed out and replaced if they were dropped,
+    on_connect(conn) runs once for every new connection.
+    """
+
+    def __init__(self, size: int = POOL_SIZE, on_connect=None):
+        # psycopg2 closes a returned connection once minconn connections are idle, so all of them are kept open.
+        self.pool = psycopg2.pool.ThreadedConnectionPool(size, size, connection_factory=PooledConnection,
+                                                         **connection_params())
+        self.available = threading.Semaphore(size)
+        self.on_connect = on_connect
+
+    def checkout(self):
+        conn = self.pool.getconn()
+        if not self.is_healthy(conn):
+            print('Reconnecting to the PostgreSQL database...')
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+        if not conn.initialized:
+            try:
+                if self.on_connect is not None:
+                    self.on_connect(conn)
+                conn.initialized = True
+            except Exception:
+                self.pool.putconn(conn, close=True)
+                raise
+        return conn
+
+    @staticmethod
+    def is_healthy(conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends a healthy connection. The open transaction is rolled back if the block raises,
+        connections broken by the error are closed and replaced on the next checkout.
+        """
+        with self.available:
+            conn = self.checkout()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.pool.putconn(conn, close=True)
+                raise
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                self.pool.putconn(conn, close=conn.closed != 0)
+                raise
+            self.pool.putconn(conn)
+
 
 def read_query(cur, query, params = ()):
   cur.execute(query, params)
   return cur.fetchall()
 
 def write_query(cur, query, params = ()):
-  cur.execute(query, params)
\ No newline at end of file
+  cur.execute(query, params)
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep
+
+import bank as bank
+import learner as learner
+import logs as logs
+import membership as membership
+import transport as transport
+from cluster import ADDRESSES, GROUPS, NODE_ID, group_of, group_of_request
+from proposer import Proposer
+
+logger = logs.get_logger('GROUPS', 'groups.log')
+
+# Threads driving transfers between accounts of different groups through their steps.
+TRANSFER_THREADS = int(os.environ.get("TRANSFER_THREADS", 32))
+transfers = ThreadPoolExecutor(max_workers=TRANSFER_THREADS, thread_name_prefix="transfer")
+# Interval at which the preferred node completes cross-group transfers left unfinished, e.g. by a crashed node.
+# A transfer is completed once it was seen unfinished by two consecutive scans.
+TRANSFER_RECOVERY_INTERVAL_MS = float(os.environ.get("TRANSFER_RECOVERY_INTERVAL_MS", 5000))
+
+
+class GroupRouter:
+    """
+    Runs a proposer for every group and routes client operations to the group owning their accounts.
+    Transfers between groups are decided as three steps: TRANSFER_OUT in the source group, TRANSFER_IN
+    in the destination group and TRANSFER_DONE in the source group. Every step is applied at most once,
+    so a transfer interrupted at any point is completed by running all of its steps again.
+    """
+
+    def __init__(self):
+        self.proposers = [Proposer(group) for group in range(GROUPS)]
+        if GROUPS > 1:
+            membership.detector.start()
+            threading.Thread(target=self.recovery, name="transfer-recovery", daemon=True).start()
+
+    @staticmethod
+    def group_of_operation(op: bank.BankOperation) -> int:
+        match op.op_type:
+            case bank.BankOpType.OPEN_ACCOUNT:
+                return group_of_request(op.request_id)
+            case bank.BankOpType.DEPOSIT | bank.BankOpType.WITHDRAW:
+                return group_of(op.args["id"])
+            case bank.BankOpType.TRANSFER | bank.BankOpType.TRANSFER_OUT:
+                return group_of(op.args["from_id"])
+            case bank.BankOpType.TRANSFER_IN:
+                return group_of(op.args["to_id"])
+            case bank.BankOpType.TRANSFER_DONE | bank.BankOpType.RECONFIGURE:
+                return op.args["group"]
+            case _:
+                raise ValueError("Operation type unrecognised!")
+
+    @staticmethod
+    def cross_group(op: bank.BankOperation) -> bool:
+        return op.op_type == bank.BankOpType.TRANSFER and group_of(op.args["from_id"]) != group_of(op.args["to_id"])
+
+    def execute(self, op: bank.BankOperation) -> Future:
+        """
+        Executes the client operation in the group owning it, see Proposer.execute.
+        """
+        if self.cross_group(op):
+            return transfers.submit(self.transfer, op)
+        return self.proposers[self.group_of_operation(op)].execute(op)
+
+    def propose(self, op: bank.BankOperation) -> Future:
+        """
+        Proposes an operation forwarded by another node in the group owning it, see Proposer.propose.
+        """
+        if self.cross_group(op):
+            return transfers.submit(self.transfer, op)
+        return self.proposers[self.group_of_operation(op)].propose(op)
+
+    def read(self, ids: list, stale: bool = False) -> list:
+        """
+        Reads the accounts from the groups owning them, see Proposer.read.
+        """
+        by_group = {}
+        for id in ids:
+            by_group.setdefault(group_of(id), []).append(id)
+        accounts = {}
+        for group, group_ids in by_group.items():
+            for account in self.proposers[group].read(group_ids, stale):
+                accounts[account["id"]] = account
+        return [accounts[id] for id in ids]
+
+    def step(self, group: int, op_type: bank.BankOpType, args: dict, request_id: str) -> dict:
+        op = bank.BankOperation(op_type=op_type, args=args, request_id=request_id)
+        return self.proposers[group].execute(op).result()
+
+    def transfer(self, op: bank.BankOperation) -> dict:
+        """
+        Moves funds between accounts of different groups. The transfer is identified by the client request id,
+        its steps by the request id and the step, so a retried request continues the transfer it started.
+        """
+        from_id, to_id, amount = op.args["from_id"], op.args["to_id"], op.args["amount"]
+        transfer_id = op.request_id
+        # TRANSFER_IN cannot fail for insufficient funds, only an account that does not exist would keep the
+        # debited funds outgoing. Accounts are never closed, so reading it once is enough.
+        self.read([to_id])
+
+        account_from = self.step(group_of(from_id), bank.BankOpType.TRANSFER_OUT,
+                                 {"from_id": from_id, "to_id": to_id, "amount": amount, "transfer_id": transfer_id},
+                                 f"{transfer_id}:out")
+        account_to = self.complete(group_of(from_id), transfer_id, to_id, amount)
+        return {"account_from": account_from, "account_to": account_to}
+
+    def complete(self, group: int, transfer_id: str, to_id: str, amount: int) -> dict:
+        """
+        Credits the destination account of a transfer debited in the group, then marks the transfer as done.
+        """
+        account_to = self.step(group_of(to_id), bank.BankOpType.TRANSFER_IN,
+                               {"to_id": to_id, "amount": amount, "transfer_id": transfer_id}, f"{transfer_id}:in")
+        self.step(group, bank.BankOpType.TRANSFER_DONE, {"transfer_id": transfer_id, "group": group},
+                  f"{transfer_id}:done")
+        return account_to
+
+    def reconfigure(self, members: dict, phase1_quorum: int, phase2_quorum: int, request_id: str) -> list:
+        """
+        Changes the nodes deciding the runs of every group to members, {node id: address}. Nodes joining the
+        cluster first install a snapshot of the state this node has applied, so that they do not need runs
+        compacted by the acceptors, then the configuration is decided in every group. It takes effect
+        configuration.WINDOW runs after the run it is decided in. A retried request with the same id
+        decides it at most once per group.
+        """
+        args = {"members": json.dumps(members), "phase1_quorum": phase1_quorum or 0,
+                "phase2_quorum": phase2_quorum or 0}
+        config = bank.parse_configuration(args["members"], args["phase1_quorum"], args["phase2_quorum"])
+        ADDRESSES.update(config.members)
+
+        joining = set(config.members) - set.union(*(instance.members() for instance in learner.instances))
+        run_ids = [instance.run_id for instance in learner.instances]
+        for id in sorted(joining):
+            logger.debug("Bootstrapping node %s up to runs %s.", id, run_ids)
+            transport.get_peer(id).put("learner_bootstrap", run_ids, learner.BOOTSTRAP_TIMEOUT_MS / 1000)
+
+        return [self.step(group, bank.BankOpType.RECONFIGURE, {**args, "group": group}, f"{request_id}:{group}")
+                for group in range(GROUPS)]
+
+    def recovery(self):
+        """
+        Completes, on the preferred node only, the transfers that stay outgoing for a whole interval.
+        """
+        seen = set()
+        while True:
+            sleep(TRANSFER_RECOVERY_INTERVAL_MS / 1000)
+            if membership.detector.preferred() != NODE_ID:
+                seen = set()
+                continue
+            with bank.lock:
+                outgoing = {(group, transfer_id): transfer for group, table in enumerate(bank.tables)
+                            for transfer_id, transfer in table.outgoing.items()}
+            for (group, transfer_id), (to_id, amount) in outgoing.items():
+                if (group, transfer_id) not in seen:
+                    continue
+                logger.debug("Completing transfer %s of %s to %s from group %s.", transfer_id, amount, to_id, group)
+                try:
+                    self.complete(group, transfer_id, to_id, amount)
+                except Exception as error:
+                    logger.debug("Completing transfer %s failed. Reason: %s", transfer_id, error)
+            seen = set(outgoing)
@@ -0,0 +1,386 @@
+import os
+import json
+import logging
+import random
+import threading
+from time import sleep, time
+from typing import List
+from fastapi import APIRouter, Body, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+import bank as bank
+import logs as logs
+import transport as transport
+from cluster import GROUPS, NODE_ID
+from configuration import WINDOW, Configuration
+from workers import ThreadLimiter
+
+# Time a run may stay undecided while later runs are decided before the learner runs Paxos for it.
+GAP_TIMEOUT_MS = float(os.environ.get("LEARNER_GAP_TIMEOUT_MS", 500))
+# Number of applied runs whose batches are kept to serve catch-up requests of lagging peers.
+RETAIN_RUNS = int(os.environ.get("LEARNER_RETAIN_RUNS", 10000))
+# Gaps longer than this are closed by fetching decided batches from a peer instead of running Paxos.
+CATCHUP_MIN_RUNS = int(os.environ.get("LEARNER_CATCHUP_MIN_RUNS", 16))
+# Number of runs sent in a single line of the catch-up stream.
+CATCHUP_CHUNK_RUNS = int(os.environ.get("LEARNER_CATCHUP_CHUNK_RUNS", 256))
+# Maximum time a linearizable read waits for the runs before its read index to be applied.
+READ_TIMEOUT_MS = float(os.environ.get("LEARNER_READ_TIMEOUT_MS", 5000))
+# Maximum time a joining node takes to install a snapshot of the state before it becomes a member.
+BOOTSTRAP_TIMEOUT_MS = float(os.environ.get("LEARNER_BOOTSTRAP_TIMEOUT_MS", 30000))
+# Threads handling DECIDED messages from peers.
+THREADS = int(os.environ.get("LEARNER_THREADS", 4))
+
+logger = logs.get_logger('LEARNER', 'learner.log')
+
+
+class Learner:
+    """
+    Collects batches decided in a group, announced by local and remote proposers, and applies them to the bank
+    in run_id order from a background thread.
+    """
+
+    def __init__(self, group: int = 0):
+        self.group = group
+        # Runs after the last bank checkpoint are learned again from the peers and the acceptors.
+        self.run_id = bank.tables[group].run_id
+
+        # self.run_id is the next run to apply, decided holds batches of later runs waiting for the earlier ones.
+        self.cond = threading.Condition()
+        self.decided = {}
+        self.max_decided_run_id = self.run_id - 1
+        # Every run up to required_run_id has to be learned, even if no later run is decided.
+        self.required_run_id = self.run_id - 1
+        # Runs a local proposer is deciding, with the batch decided in them once it is known, and their results.
+        self.watched = {}
+        self.results = {}
+        self.fill_gap = None
+        # Batches of applied runs in [retained_from, run_id), in the BankBatch.to_tuple() form.
+        self.retained = {}
+        self.retained_from = self.run_id
+
+    def log(self, run_id: int, message: str, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message, *args, extra={"group": self.group if GROUPS > 1 else None, "run_id": run_id})
+
+    def start(self, fill_gap):
+        """
+        Starts the applier. fill_gap(run_id) is called to learn the value of a run that stays undecided
+        while later runs are decided and has to return the batch decided in it.
+        """
+        self.fill_gap = fill_gap
+        threading.Thread(target=self.applier, name=f"applier-{self.group}", daemon=True).start()
+
+    def next_run_id(self) -> int:
+        """
+        Returns the lowest run_id above every run known to be decided.
+        """
+        with self.cond:
+            return self.max_decided_run_id + 1
+
+    def decide(self, run_id: int, batch: bank.BankBatch):
+        with self.cond:
+            self.decide_locked(run_id, batch)
+
+    def decide_locked(self, run_id: int, batch: bank.BankBatch):
+        if run_id < self.run_id or run_id in self.decided:
+            return
+        self.decided[run_id] = batch
+        if run_id in self.watched:
+            self.watched[run_id] = batch
+        self.max_decided_run_id = max(self.max_decided_run_id, run_id)
+        self.cond.notify_all()
+
+    def watch(self, run_id: int):
+        """
+        Keeps the decided batch and the results of applying the run for learned and wait_applied.
+        Has to be called before the run can be decided.
+        """
+        with self.cond:
+            self.watched[run_id] = None
+
+    def unwatch(self, run_id: int):
+        with self.cond:
+            self.watched.pop(run_id, None)
+            self.results.pop(run_id, None)
+
+    def learned(self, run_id: int) -> bank.BankBatch:
+        """
+        Returns the batch decided in the run if it is waiting to be applied, the run is watched or it was
+        applied and is still retained, None otherwise.
+        """
+        with self.cond:
+            if run_id in self.decided:
+                return self.decided[run_id]
+            if run_id in self.retained:
+                return bank.BankBatch.from_tuple(self.retained[run_id])
+            return self.watched.get(run_id)
+
+    def wait_learned(self, run_id: int, timeout: float) -> bank.BankBatch:
+        """
+        Like learned, but waits up to timeout seconds for the run to be decided.
+        """
+        deadline = time() + timeout
+        with self.cond:
+            while True:
+                batch = self.decided.get(run_id, self.watched.get(run_id))
+                if batch is not None or run_id < self.run_id or time() >= deadline:
+                    return batch
+                self.cond.wait(deadline - time())
+
+    def configuration(self, run_id: int) -> Configuration:
+        """
+        Returns the configuration the run is decided in, once every run WINDOW runs before it has been applied.
+        Returns None if the run was already applied.
+        """
+        with self.cond:
+            if self.run_id <= run_id - WINDOW:
+                self.required_run_id = max(self.required_run_id, run_id - WINDOW)
+                self.cond.notify_all()
+            while self.run_id <= run_id - WINDOW:
+                self.cond.wait()
+            return bank.tables[self.group].configurations.at(run_id)
+
+    def members(self) -> set:
+        """
+        Returns the nodes deciding the next run to apply or any later one.
+        """
+        with self.cond:
+            return bank.tables[self.group].configurations.members_from(self.run_id)
+
+    def wait_applied(self, run_id: int) -> list:
+        """
+        Waits until the watched run has been applied and returns the results (or errors) of its operations.
+        """
+        with self.cond:
+            while self.run_id <= run_id:
+                self.cond.wait()
+            self.watched.pop(run_id)
+            if run_id not in self.results:
+                # The run was skipped by installing a peer's snapshot, its results are unknown.
+                raise HTTPException(status_code=503, detail="Service unavailable.")
+            return self.results.pop(run_id)
+
+    def read(self, ids: list, run_id: int = None) -> list:
+        """
+        Returns the accounts with the given ids once every run up to run_id has been applied,
+        or right away from the current state if run_id is None.
+        """
+        with self.cond:
+            if run_id is not None:
+                self.required_run_id = max(self.required_run_id, run_id)
+                self.cond.notify_all()
+                deadline = time() + READ_TIMEOUT_MS / 1000
+                while self.run_id <= run_id:
+                    if time() >= deadline:
+                        self.log(run_id, "Read timed out waiting for run %s.", self.run_id)
+                        raise HTTPException(status_code=503, detail="Service unavailable.")
+                    self.cond.wait(deadline - time())
+            return bank.get_accounts(ids)
+
+    def apply(self, run_id: int, batch: bank.BankBatch) -> list:
+        """
+        Applies a decided batch. Operations that are invalid at this point of the log
+        are no-ops on every node, their error is handed to the client that proposed them.
+        """
+        results = bank.execute_batch(batch, run_id, self.group)
+        for op, res in zip(batch.ops, results):
+            if isinstance(res, HTTPException):
+                self.log(run_id, "Decided operation %s failed: %s", op, res.detail)
+        return results
+
+    def applier(self):
+        # Runs decided while this node was down are only announced to the nodes that were up.
+        self.catch_up()
+        while True:
+            gap_run_id = self.apply_decided()
+            with self.cond:
+                lag = max(self.max_decided_run_id, self.required_run_id) - gap_run_id
+            if lag >= CATCHUP_MIN_RUNS and self.catch_up():
+                continue
+
+            self.log(gap_run_id, "Run is still undecided, learning its value.")
+            try:
+                self.decide(gap_run_id, self.fill_gap(gap_run_id))
+            except Exception as error:
+                self.log(gap_run_id, "Learning the value failed. Reason: %s", error)
+
+    def apply_ready(self):
+        """
+        Applies every decided batch that is next in run_id order. Has to be called under self.cond.
+        """
+        if self.run_id not in self.decided:
+            return
+        while self.run_id in self.decided:
+            run_id = self.run_id
+            batch = self.decided.pop(run_id)
+            results = self.apply(run_id, batch)
+            if run_id in self.watched:
+                self.results[run_id] = results
+
+            self.retained[run_id] = batch.to_tuple()
+            while len(self.retained) > RETAIN_RUNS:
+                self.retained.pop(self.retained_from, None)
+                self.retained_from += 1
+            self.run_id += 1
+        self.cond.notify_all()
+
+    def apply_decided(self) -> int:
+        """
+        Applies decided batches in run_id order. Returns the next run once it has stayed undecided
+        for GAP_TIMEOUT_MS while a later run was decided or a read waits for it.
+        """
+        deadline = None
+        with self.cond:
+            while True:
+                if self.run_id in self.decided:
+                    self.apply_ready()
+                    deadline = None
+                elif self.max_decided_run_id > self.run_id or self.required_run_id >= self.run_id:
+                    # Give the proposer of the missing run, or its DECIDED message, some time before stepping in.
+                    if deadline is None:
+                        deadline = time() + GAP_TIMEOUT_MS / 1000
+                    if time() >= deadline:
+                        return self.run_id
+                    self.cond.wait(deadline - time())
+                else:
+                    self.cond.wait()
+
+    def catch_up(self, snapshot: bool = False) -> bool:
+        """
+        Fetches the batches decided since self.run_id from a peer, or its bank state if the peer
+        no longer retains them or snapshot is set, and applies them. Returns whether any run was applied.
+        """
+        peers = list(self.members() - {NODE_ID})
+        random.shuffle(peers)
+        for id in peers:
+            with self.cond:
+                from_run_id = self.run_id
+            self.log(from_run_id, "Catching up from node %s.", id)
+            try:
+                params = {"from_run_id": from_run_id, "group": self.group, "snapshot": snapshot}
+                for message in transport.get_peer(id).stream("learner_catchup", params):
+                    if "snapshot" in message:
+                        state = message["snapshot"]
+                        self.install_snapshot(state["run_id"], state["accounts"], state.get("requests", []),
+                                              state.get("transfers"), state.get("configurations"))
+                        continue
+                    with self.cond:
+                        for run_id, val in message["runs"]:
+                            self.decide_locked(run_id, bank.BankBatch.from_tuple(val))
+                        self.apply_ready()
+            except Exception as error:
+                self.log(from_run_id, "Catching up from node %s failed. Reason: %s", id, error)
+            with self.cond:
+                if self.run_id > from_run_id:
+                    self.log(self.run_id, "Caught up from node %s.", id)
+                    return True
+        return False
+
+    def install_snapshot(self, run_id: int, accounts: list, requests: list, transfers: dict = None,
+                         configurations: list = None):
+        """
+        Replaces the state of the group with the state of a peer after applying every run before run_id.
+        """
+        with self.cond:
+            if run_id <= self.run_id:
+                return
+            self.log(run_id, "Installing a snapshot of %s accounts.", len(accounts))
+            bank.restore_accounts([tuple(account) for account in accounts], run_id, self.group, requests, transfers,
+                                  configurations)
+            self.decided = {id: batch for id, batch in self.decided.items() if id >= run_id}
+            self.retained = {}
+            self.retained_from = run_id
+            self.run_id = run_id
+            self.max_decided_run_id = max(self.max_decided_run_id, run_id - 1)
+            self.cond.notify_all()
+
+    def catch_up_stream(self, from_run_id: int, snapshot: bool = False):
+        """
+        Yields lines of the catch-up stream for a peer that has applied every run before from_run_id:
+        applied batches in chunks of CATCHUP_CHUNK_RUNS, preceded by a snapshot if they are no longer retained
+        or snapshot is set.
+        """
+        with self.cond:
+            if snapshot or from_run_id < self.retained_from:
+                accounts, requests, transfers, configurations = bank.dump_accounts(self.group)
+                snapshot = {"run_id": self.run_id, "accounts": accounts, "requests": requests, "transfers": transfers,
+                            "configurations": configurations}
+                from_run_id = self.run_id
+            else:
+                snapshot = None
+        if snapshot is not None:
+            yield json.dumps({"snapshot": snapshot}) + "\n"
+
+        while True:
+            with self.cond:
+                runs = [(run_id, self.retained[run_id])
+                        for run_id in range(from_run_id, min(self.run_id, from_run_id + CATCHUP_CHUNK_RUNS))
+                        if run_id in self.retained]
+            if not runs:
+                return
+            yield json.dumps({"runs": runs}) + "\n"
+            from_run_id = runs[-1][0] + 1
+
+    def bootstrap(self, run_id: int):
+        """
+        Installs a peer's snapshot of the state, unless every run before run_id has already been applied.
+        """
+        deadline = time() + BOOTSTRAP_TIMEOUT_MS / 1000
+        snapshot = True
+        while self.run_id < run_id:
+            if time() >= deadline:
+                self.log(self.run_id, "Bootstrapping up to run %s timed out.", run_id)
+                raise HTTPException(status_code=503, detail="Service unavailable.")
+            # Runs decided after the snapshot are streamed without sending the whole state again.
+            if self.catch_up(snapshot):
+                snapshot = False
+            else:
+                sleep(GAP_TIMEOUT_MS / 1000)
+
+
+class DecidedMessage(BaseModel):
+    run_id: int = None
+    val: bank.BankBatch = None
+    group: int = 0
+
+    def __init__(self, run_id: int, val: bank.BankBatch, group: int = 0):
+        super().__init__()
+        self.run_id = run_id
+        self.val = val
+        self.group = group
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+
+router = APIRouter()
+instances = [Learner(group) for group in range(GROUPS)]
+threads = ThreadLimiter("learner_threads", THREADS)
+
+
+def instance_of(group: int) -> Learner:
+    if not 0 <= group < len(instances):
+        raise HTTPException(status_code=404, detail="Group not found.")
+    return instances[group]
+
+
+@router.put("/learner_decided")
+async def learner_decided(body: DecidedMessage):
+    logger.debug("Received %s", body)
+    await threads.run(instance_of(body.group).decide, body.run_id, bank.as_batch(body.val))
+    return {}
+
+
+@router.get("/learner_catchup")
+async def learner_catchup(from_run_id: int, group: int = 0, snapshot: bool = False):
+    return StreamingResponse(instance_of(group).catch_up_stream(from_run_id, snapshot),
+                             media_type="application/x-ndjson")
+
+
+# Called on a joining node before the reconfiguration adding it is proposed, with the runs applied by the caller.
+@router.put("/learner_bootstrap")
+def learner_bootstrap(run_ids: List[int] = Body()):
+    for learner, run_id in zip(instances, run_ids):
+        learner.bootstrap(run_id)
+    return {"run_ids": [learner.run_id for learner in instances]}
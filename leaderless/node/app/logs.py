@@ -0,0 +1,97 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+from cluster import NODE_ID
+
+# Lowest level written by every logger, DEBUG traces every consensus message. LOG_LEVEL_<NAME>,
+# e.g. LOG_LEVEL_ACCEPTOR, overrides it for a single logger.
+LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text" for the human readable format, "json" for one JSON object per line.
+FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Whether records are written to stderr as well as to the log file of their logger.
+CONSOLE = os.environ.get("LOG_CONSOLE", "1") == "1"
+
+# Context fields passed with extra=..., in the order in which they prefix text messages.
+FIELDS = {"group": "GROUP", "run_id": "RUN", "propose_id": "PROPOSE_ID", "acceptor_state": "ACCEPTOR_STATE"}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(levelname)s:    %(name)s:    %(context)s%(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = [f"[{label}: {getattr(record, field)}]" for field, label in FIELDS.items()
+                   if getattr(record, field, None) is not None]
+        record.context = " ".join(context) + ":    " if context else ""
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name, "node_id": NODE_ID}
+        for field in FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        entry["message"] = record.getMessage()
+        return json.dumps(entry, default=str)
+
+
+class LoggerFiles(logging.Handler):
+    """
+    Writes every record to the file of the logger that created it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def add(self, name: str, handler: logging.Handler):
+        self.files[name] = handler
+
+    def emit(self, record: logging.LogRecord):
+        handler = self.files.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are. Unlike QueueHandler, it does not format them on the logging thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+formatter = JsonFormatter() if FORMAT == "json" else TextFormatter()
+files = LoggerFiles()
+handlers = [files]
+if CONSOLE:
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    handlers.append(console)
+
+# Loggers only put records on the queue, a single background thread formats and writes them,
+# so that request threads neither format messages nor wait for the disk or the terminal.
+records = queue.SimpleQueue()
+listener = logging.handlers.QueueListener(records, *handlers)
+listener.start()
+atexit.register(listener.stop)
+
+
+def get_logger(name: str, path: str) -> logging.Logger:
+    """
+    Returns the logger writing to the given file through the background writer. Messages should be
+    passed as %-style format strings with arguments, so that they are not built below the logger's level.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(os.environ.get(f"LOG_LEVEL_{name}", LEVEL).upper())
+    fh = logging.FileHandler(path)
+    fh.setFormatter(formatter)
+    files.add(name, fh)
+    logger.addHandler(RecordQueueHandler(records))
+    return logger
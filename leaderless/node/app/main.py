@@ -1,17 +1,33 @@
+import asyncio
+import os
+import uuid
+
 from anyio import CapacityLimiter
 from anyio.lowlevel import RunVar
-from fastapi import FastAPI
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Header, Query
 from pydantic import BaseModel, Field
 import uvicorn
 
 import bank as bank
-from proposer import Proposer
+from groups import GroupRouter
 import acceptor as acceptor
+import learner as learner
+import transport as transport
+from workers import ThreadLimiter
 
 
 app = FastAPI()
 app.include_router(acceptor.router)
-proposer = Proposer()
+app.include_router(learner.router)
+router = GroupRouter()
+
+# Size of the default thread pool running the remaining synchronous endpoints.
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 40))
+# Threads serving balance reads. Writes do not hold a thread while their batch goes through consensus.
+CLIENT_THREADS = int(os.environ.get("CLIENT_THREADS", 16))
+client_threads = ThreadLimiter("client_threads", CLIENT_THREADS)
 
 config = uvicorn.Config(app, host="0.0.0.0", port=80, log_level="info")
 server = uvicorn.Server(config=config)
@@ -27,38 +43,72 @@ class Transfer(BaseModel):
     amount: int = Field(ge=0)
 
 
+class Reconfiguration(BaseModel):
+    # {node id: "host:port"} of every node of the new configuration, quorums default to a majority.
+    members: Dict[int, str]
+    phase1_quorum: Optional[int] = None
+    phase2_quorum: Optional[int] = None
+
+
 @app.on_event("startup")
 def startup():
-    RunVar("_default_thread_limiter").set(CapacityLimiter(1))
+    RunVar("_default_thread_limiter").set(CapacityLimiter(WORKER_THREADS))
 
 
 @app.get("/health")
-def healthcheck():
+async def healthcheck():
     return {"healthy": "true"}
 
 
+@app.get("/peer_stats")
+def peer_stats():
+    return transport.stats()
+
+
+@app.get("/balance/{id}")
+async def get_balance(id: str, stale: bool = False):
+    return (await client_threads.run(router.read, [id], stale))[0]
+
+
+@app.get("/balances")
+async def get_balances(ids: List[str] = Query(), stale: bool = False):
+    return await client_threads.run(router.read, ids, stale)
+
+
+# Clients may pass an X-Request-ID header, a retried request with the same id is applied at most once.
 @app.post("/open")
-def open_bank_account():
-    op = bank.BankOperation(op_type=bank.BankOpType.OPEN_ACCOUNT, args={})
-    return proposer.execute(op)
+async def open_bank_account(x_request_id: Optional[str] = Header(None)):
+    op = bank.BankOperation(op_type=bank.BankOpType.OPEN_ACCOUNT, args={}, request_id=x_request_id)
+    return await asyncio.wrap_future(router.execute(op))
 
 
 @app.put("/deposit")
-def deposit_funds(body: UpdateBalance):
-    op = bank.BankOperation(op_type=bank.BankOpType.DEPOSIT, args=body.dict())
-    return proposer.execute(op)
+async def deposit_funds(body: UpdateBalance, x_request_id: Optional[str] = Header(None)):
+    op = bank.BankOperation(op_type=bank.BankOpType.DEPOSIT, args=body.dict(), request_id=x_request_id)
+    return await asyncio.wrap_future(router.execute(op))
 
 
 @app.put("/withdraw")
-def withdraw_funds(body: UpdateBalance):
-    op = bank.BankOperation(op_type=bank.BankOpType.WITHDRAW, args=body.dict())
-    return proposer.execute(op)
+async def withdraw_funds(body: UpdateBalance, x_request_id: Optional[str] = Header(None)):
+    op = bank.BankOperation(op_type=bank.BankOpType.WITHDRAW, args=body.dict(), request_id=x_request_id)
+    return await asyncio.wrap_future(router.execute(op))
 
 
 @app.put("/transfer")
-def transfer_funds(body: Transfer):
-    op = bank.BankOperation(op_type=bank.BankOpType.TRANSFER, args=body.dict())
-    return proposer.execute(op)
+async def transfer_funds(body: Transfer, x_request_id: Optional[str] = Header(None)):
+    op = bank.BankOperation(op_type=bank.BankOpType.TRANSFER, args=body.dict(), request_id=x_request_id)
+    return await asyncio.wrap_future(router.execute(op))
+
+
+@app.put("/reconfigure")
+def reconfigure(body: Reconfiguration, x_request_id: Optional[str] = Header(None)):
+    return router.reconfigure(body.members, body.phase1_quorum, body.phase2_quorum, x_request_id or str(uuid.uuid4()))
+
+
+# Operations forwarded to this node as the preferred proposer are not forwarded any further.
+@app.put("/forward")
+async def forward(body: dict):
+    return await asyncio.wrap_future(router.propose(bank.as_operation(body)))
 
 @app.get("/quit")
 def quit_app():
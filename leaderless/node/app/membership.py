@@ -0,0 +1,70 @@
+import os
+import threading
+from time import monotonic, sleep
+
+import learner as learner
+import transport as transport
+from cluster import NODE_ID
+
+# Interval at which peers that were not heard from are probed.
+HEARTBEAT_INTERVAL_MS = float(os.environ.get("HEARTBEAT_INTERVAL_MS", 200))
+# A peer that did not answer any request for this long is suspected to be down.
+FAILURE_TIMEOUT_MS = float(os.environ.get("FAILURE_TIMEOUT_MS", 1000))
+
+
+class FailureDetector:
+    """
+    Heartbeat failure detector. Every successful request to a peer counts as a heartbeat,
+    peers that were not heard from for HEARTBEAT_INTERVAL_MS are probed through /health.
+    Only members of the configurations of group 0 are probed, nodes added later are probed once they join.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = False
+        self.probed = set()
+
+    def start(self):
+        """
+        Starts probing the peers, once however many times it is called.
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.probe_members()
+        threading.Thread(target=self.watch_members, name="heartbeat-members", daemon=True).start()
+
+    def probe_members(self):
+        for id in learner.instances[0].members() - self.probed - {NODE_ID}:
+            self.probed.add(id)
+            threading.Thread(target=self.heartbeat, args=(id,), name=f"heartbeat-{id}", daemon=True).start()
+
+    def watch_members(self):
+        while True:
+            sleep(HEARTBEAT_INTERVAL_MS / 1000)
+            self.probe_members()
+
+    def heartbeat(self, id: int):
+        peer = transport.get_peer(id)
+        while True:
+            if monotonic() - peer.last_success >= HEARTBEAT_INTERVAL_MS / 1000:
+                try:
+                    peer.get("health")
+                except Exception:
+                    pass
+            sleep(HEARTBEAT_INTERVAL_MS / 1000)
+
+    def alive(self, id: int) -> bool:
+        return id == NODE_ID or monotonic() - transport.get_peer(id).last_success < FAILURE_TIMEOUT_MS / 1000
+
+    def preferred(self) -> int:
+        """
+        Returns the preferred proposer: the lowest member that is not suspected to be down,
+        this node if every member is.
+        """
+        return min((id for id in learner.instances[0].members() if self.alive(id)), default=NODE_ID)
+
+
+# Shared by every component that needs to know which peers are up.
+detector = FailureDetector()
@@ -1,33 +1,65 @@
 import logging
 import os
-import pickle
 import random
-from time import sleep
-from fastapi import HTTPException
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from time import sleep, time
 import requests
+from fastapi import HTTPException
 
 import bank as bank
 import acceptor as acceptor
+import learner as learner
+import logs as logs
+import membership as membership
+import transport as transport
+import wire as wire
+from cluster import FAST_PROPOSE_ID, GROUPS, MAX_NODES, NODE_ID
+from configuration import FAST_PATH, INITIAL, Configuration
 
-FILE_NAME = "proposer.pickle"
-
-logger = logging.getLogger('PROPOSER')
-logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler('proposer.log')
-fh.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s:    %(name)s:    %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
+logger = logs.get_logger('PROPOSER', 'proposer.log')
 
 
-NODES = 5
-NODE_ID = int(os.environ["NODE_ID"])
+# Threads used to send DECIDED messages to all peers in parallel.
+FANOUT_THREADS = int(os.environ.get("FANOUT_THREADS", 4 * INITIAL.nodes))
+executor = ThreadPoolExecutor(max_workers=FANOUT_THREADS, thread_name_prefix="fanout")
 
 EXP_BACKOFF_MULTIPLIER = 2
+# Retries of a run lost to another proposer wait a random time up to BACKOFF_MAX_MS, starting from
+# the observed round trip time of a broadcast (at least BACKOFF_MIN_MS) and growing exponentially.
+BACKOFF_MIN_MS = float(os.environ.get("BACKOFF_MIN_MS", 0.5))
+BACKOFF_MAX_MS = float(os.environ.get("BACKOFF_MAX_MS", 250))
+# A node NACKed in favour of a lower node id additionally waits this many round trips for it to decide the run.
+BACKOFF_DEFER_RTTS = float(os.environ.get("BACKOFF_DEFER_RTTS", 4))
+# Weight of the latest sample in the moving average of the broadcast round trip time.
+RTT_EWMA_WEIGHT = 0.2
+
+# Interval at which the node reports the runs it has applied to every acceptor, so that runs are compacted
+# even while it does not propose.
+GC_REPORT_INTERVAL_MS = float(os.environ.get("GC_REPORT_INTERVAL_MS", 1000))
+# Maximum number of runs this node drives through consensus at the same time.
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 8))
+
+# Client operations arriving within BATCH_WINDOW_MS of each other, up to BATCH_MAX_SIZE of them,
+# are decided together as a single value in one run.
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 64))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 2))
+# A batch holds a pipeline slot until it is decided and its thread until it is applied.
+committer = ThreadPoolExecutor(max_workers=2 * PIPELINE_DEPTH, thread_name_prefix="commit")
+
+# When enabled, a proposer that wins Phase 1 keeps its propose id for all later runs
+# and only sends ACCEPT messages until another node preempts it.
+MULTI_PAXOS = os.environ.get("MULTI_PAXOS", "0") == "1"
+
+# When enabled, client operations are forwarded to the preferred proposer, the lowest node id that is
+# not suspected to be down, and batched there instead of competing for runs with the other nodes.
+# Nodes propose themselves if it cannot be reached.
+PREFERRED_PROPOSER = os.environ.get("PREFERRED_PROPOSER", "0") == "1"
+# Threads waiting for the results of operations forwarded to the preferred proposer.
+FORWARD_THREADS = int(os.environ.get("FORWARD_THREADS", 64))
+forwarder = ThreadPoolExecutor(max_workers=FORWARD_THREADS, thread_name_prefix="forward")
 
 
 class NotEnoughNodesAvailable(Exception):
@@ -38,130 +70,561 @@ class NotEnoughNodesAvailable(Exception):
     pass
 
 
-def backoff(retries: int):
-    backoff = random.randint(0, 2**retries - 1)
-    logger.debug(f"Retrying after {backoff} seconds.")
-    sleep(backoff)
+class ContentionManager:
+    """
+    Spaces out retries of runs lost to competing proposers. Delays are exponential jitter scaled
+    to the round trip time of broadcasts and capped at BACKOFF_MAX_MS. Node ids double as priorities:
+    a proposer beaten by a lower node id defers to it for a few round trips before competing again.
+    """
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rtt = BACKOFF_MIN_MS / 1000
 
-def next_unique(number: int):
-    return (number // NODES + 1) * NODES + NODE_ID
+    def observe(self, rtt: float):
+        with self.lock:
+            self.rtt += RTT_EWMA_WEIGHT * (rtt - self.rtt)
 
+    def delay(self, retries: int, promised_by: int = None) -> float:
+        with self.lock:
+            base = max(self.rtt, BACKOFF_MIN_MS / 1000)
+        delay = random.uniform(0, min(BACKOFF_MAX_MS / 1000, base * EXP_BACKOFF_MULTIPLIER ** retries))
+        if promised_by is not None and promised_by < NODE_ID:
+            delay += min(BACKOFF_MAX_MS / 1000, base * BACKOFF_DEFER_RTTS)
+        return delay
 
-class Proposer:
-    run_id: int
 
-    def __init__(self):
-        try:
-            with open(FILE_NAME, "rb") as infile:
-                on_disk_proposer = pickle.load(infile)
-                self.run_id = on_disk_proposer.run_id
+def resolve(future: Future, res):
+    """
+    Resolves the future with the result of an applied operation, which is an HTTPException if it failed.
+    """
+    if isinstance(res, HTTPException):
+        future.set_exception(res)
+    else:
+        future.set_result(res)
+
 
-        except FileNotFoundError:
-            self.run_id = 0
+def choose_value(promises: list, responses_cnt: int, config: Configuration) -> dict:
+    """
+    Returns the PROMISE a proposer acts on in a run, given the {"accepted_id", "accepted_val"} of the promises
+    with an accepted value, out of responses_cnt promises in total. Values of classic rounds are re-proposed
+    as usual. A fast round value is re-proposed if it could have been chosen, i.e. if acceptors that did not
+    answer could make up a fast quorum of votes for it. Otherwise nothing was chosen and the commutative fast round
+    values are merged into one, marked with "merged" so that the proposer may add its own operations.
+    """
+    if not promises:
+        return {"accepted_id": -1, "accepted_val": None}
+    highest = max(promises, key=lambda r: r["accepted_id"])
+    if highest["accepted_id"] != FAST_PROPOSE_ID:
+        return highest
 
-    def serialize(self):
-        with open(FILE_NAME, "wb") as outfile:
-            pickle.dump(self, outfile)
+    votes = Counter(bank.as_batch(r["accepted_val"]).to_tuple() for r in promises)
+    val, votes_cnt = votes.most_common(1)[0]
+    if votes_cnt + config.nodes - responses_cnt >= config.fast_quorum:
+        return {"accepted_id": FAST_PROPOSE_ID, "accepted_val": bank.BankBatch.from_tuple(val)}
+    merged = bank.merge_batches(*(r["accepted_val"] for r in promises))
+    return {"accepted_id": FAST_PROPOSE_ID, "accepted_val": merged, "merged": True}
 
-    def log(self, propose_id: int, message: str):
-        logger.debug(f"[RUN: {self.run_id}] [PROPOSE_ID: {propose_id}]:    {message}")
 
-    def broadcast_prepare(self, propose_id: int) -> dict:
-        mess = acceptor.PrepareMessage(run_id=self.run_id, propose_id=propose_id)
-        responses = []
+def next_unique(number: int):
+    return (number // MAX_NODES + 1) * MAX_NODES + NODE_ID
 
-        self.log(propose_id, f"Broadcasting: {mess}")
 
-        for id in range(1, NODES + 1):
-            if id == NODE_ID:
-                r = acceptor.acceptor_prepare(mess)
-            else:
-                try:
-                    r = requests.put(f"http://node{id}:80/acceptor_prepare", json=mess.dict())
-                    r = r.json()
-                except Exception as error:
-                    self.log(propose_id, f"Sending PREPARE to node {id} failed. Reason: {error}")
-                    continue
+class Proposer:
+    def __init__(self, group: int = 0):
+        # Decided batches are applied by the learner, the proposer only picks runs above every run it knows of.
+        self.group = group
+        self.learner = learner.instances[group]
+        self.lock = threading.Lock()
+        self.next_run_id = self.learner.run_id
+        self.pipeline = threading.Semaphore(PIPELINE_DEPTH)
+        self.contention = ContentionManager()
+
+        # Multi-Paxos leadership: propose id promised for all runs >= leader_run_id, together with values
+        # accepted in future runs that have to be re-proposed and values proposed with the propose id since.
+        self.leader_propose_id = None
+        self.leader_run_id = None
+        self.leader_config = None
+        self.leader_accepted = {}
+        # Runs this node is running Paxos for, run id -> [lock, number of callers], so that a run is never
+        # proposed twice at once, e.g. by a client batch and by the learner filling a gap.
+        self.run_locks = {}
+        threading.Thread(target=self.report_applied, name="gc-reporter", daemon=True).start()
+
+        # Client operations waiting to be batched, together with futures resolved once they are applied.
+        self.pending = []
+        self.pending_cond = threading.Condition()
+        # Futures of the requests queued or being decided, by request id.
+        self.in_flight = {}
+        threading.Thread(target=self.batcher, name=f"batcher-{group}", daemon=True).start()
+        self.learner.start(self.fill_gap)
+
+        self.failure_detector = membership.detector
+        if PREFERRED_PROPOSER:
+            self.failure_detector.start()
+
+    def log(self, run_id: int, propose_id: int, message: str, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message, *args, extra={"group": self.group if GROUPS > 1 else None, "run_id": run_id,
+                                                "propose_id": propose_id})
+
+    def send(self, run_id: int, propose_id: int, id: int, endpoint: str, mess) -> dict:
+        try:
+            return transport.get_peer(id).put(endpoint, mess.dict())
+        except Exception as error:
+            self.log(run_id, propose_id, "Sending %s to node %s failed. Reason: %s", endpoint, id, error)
+            return None
+
+    def broadcast(self, run_id: int, propose_id: int, mess, local_handler, done, members) -> list:
+        """
+        Sends the acceptor message to the members in parallel and handles it with the local acceptor meanwhile
+        if this node is one of them. Returns as soon as done(responses) holds or every member has answered,
+        replies arriving later are dropped.
+        Messages travel in the binary wire format, coalesced with other messages to the same peer.
+        """
+        start = time()
+        futures = {}
+        for id in members:
+            if id != NODE_ID:
+                outbox = transport.get_peer(id).outbox("acceptor_batch", wire.encode_requests, wire.decode_responses)
+                futures[outbox.submit(mess.to_wire())] = id
+        responses = [local_handler(mess)] if NODE_ID in members else []
+
+        if responses and done(responses):
+            return responses
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except Exception as error:
+                self.log(run_id, propose_id, "Sending %s to node %s failed. Reason: %s",
+                         mess, futures[future], error)
+                continue
             responses.append(r)
+            if done(responses):
+                self.contention.observe(time() - start)
+                break
+        return responses
+
+    def applied_run_id(self) -> int:
+        """
+        Run up to which the group is checkpointed on this node, acceptors may forget the runs before it.
+        """
+        return bank.tables[self.group].checkpoint_run_id
+
+    def report_applied(self):
+        while True:
+            sleep(GC_REPORT_INTERVAL_MS / 1000)
+            mess = acceptor.AppliedMessage(node_id=NODE_ID, applied_run_id=self.applied_run_id(), group=self.group)
+            self.broadcast(None, None, mess, acceptor.applied, lambda responses: False, self.learner.members())
 
-        self.log(propose_id, f"Received PROMISEs: {responses}")
+    def broadcast_prepare(self, run_id: int, propose_id: int, config: Configuration,
+                          range_prepare: bool = False) -> dict:
+        mess = acceptor.PrepareMessage(run_id=run_id, propose_id=propose_id, range_prepare=range_prepare,
+                                       node_id=NODE_ID, applied_run_id=self.applied_run_id(), group=self.group)
 
-        max_accepted_id = -1
-        max_promised_id = -1
-        res = {"accepted_id": -1, "accepted_val": None}
-        for r in responses:
-            if "promised_id" in r:
-                max_promised_id = max(max_promised_id, r["promised_id"])
-                res = r
-            elif max_promised_id == -1 and r["accepted_id"] > max_accepted_id:
-                max_accepted_id = r["accepted_id"]
-                res = r
-
-        if len(responses) <= NODES // 2:
-            self.log(propose_id, f"Majority of nodes did not respond to prepare message. Responses count: {len(responses)}")
-            raise HTTPException(status_code=503, detail="Service unavailable.")
-        return res
+        self.log(run_id, propose_id, "Broadcasting: %s", mess)
 
-    def broadcast_accept(self, propose_id: int, val: bank.BankOperation) -> bool:
-        mess: acceptor.AcceptMessage = acceptor.AcceptMessage(run_id=self.run_id, propose_id=propose_id, val=val)
-        accepts_cnt = 0
+        def done(responses):
+            # A single NACK is enough to retry with a higher propose id.
+            promises = [r for r in responses if "promised_id" not in r]
+            return len(promises) >= config.phase1_quorum or len(promises) < len(responses)
 
-        self.log(propose_id, f"Broadcasting {mess}")
+        responses = self.broadcast(run_id, propose_id, mess, acceptor.prepare, done, config.members)
 
-        for id in range(1, NODES + 1):
-            if id == NODE_ID:
-                r = acceptor.acceptor_accept(mess)
-            else:
-                try:
-                    r = requests.put(f"http://node{id}:80/acceptor_accept", json=mess.dict())
-                    r = r.json()
-                except Exception as error:
-                    self.log(propose_id, f"Sending ACCEPT to node {id} failed: {error}")
-                    continue
-            if r["accepted"]:
-                accepts_cnt += 1
+        self.log(run_id, propose_id, "Received PROMISEs: %s", responses)
 
-        self.log(propose_id, f"{accepts_cnt} nodes accepted value {val}.")
+        if len(responses) < config.phase1_quorum and all("promised_id" not in r for r in responses):
+            self.log(run_id, propose_id,
+                     "Quorum of nodes did not respond to prepare message. Responses count: %s", len(responses))
+            raise HTTPException(status_code=503, detail="Service unavailable.")
 
-        return accepts_cnt > NODES // 2
+        if range_prepare:
+            return self.merge_range_promises(responses, config)
+
+        nacks = [r for r in responses if "promised_id" in r]
+        if nacks:
+            return max(nacks, key=lambda r: r["promised_id"])
+        return choose_value([r for r in responses if r["accepted_val"] is not None], len(responses), config)
+
+    def merge_range_promises(self, responses: list, config: Configuration) -> dict:
+        """
+        Combines range PROMISEs into {"accepted": {run_id: {"accepted_id", "accepted_val"}}}, choosing the value
+        of every run as choose_value does, or returns the NACK with the highest promised id. Runs are assumed
+        to be decided in config, which the leader checks before using the PROMISE of a run.
+        """
+        nacks = [r for r in responses if "promised_id" in r]
+        if nacks:
+            return max(nacks, key=lambda r: r["promised_id"])
+
+        promises = defaultdict(list)
+        for r in responses:
+            for a in r["accepted"]:
+                promises[a["run_id"]].append(a)
+        return {"accepted": {run_id: choose_value(run_promises, len(responses), config)
+                             for run_id, run_promises in promises.items()}}
+
+    def broadcast_accept(self, run_id: int, propose_id: int, val: bank.BankBatch, config: Configuration,
+                         quorum: int = None) -> bool:
+        quorum = quorum or config.phase2_quorum
+        mess: acceptor.AcceptMessage = acceptor.AcceptMessage(run_id=run_id, propose_id=propose_id, val=val,
+                                                               node_id=NODE_ID, applied_run_id=self.applied_run_id(),
+                                                               group=self.group)
+
+        self.log(run_id, propose_id, "Broadcasting %s", mess)
+
+        def done(responses):
+            accepts_cnt = sum(1 for r in responses if r["accepted"])
+            return accepts_cnt >= quorum or len(responses) - accepts_cnt > config.nodes - quorum
+
+        responses = self.broadcast(run_id, propose_id, mess, acceptor.accept, done, config.members)
+        accepts_cnt = sum(1 for r in responses if r["accepted"])
+
+        self.log(run_id, propose_id, "%s nodes accepted value %s.", accepts_cnt, val)
+
+        return accepts_cnt >= quorum
+
+    def read_index(self, configs: list) -> int:
+        """
+        Asks a read quorum of acceptors of every configuration for the highest run they accepted a value in.
+        Every operation acknowledged to a client before this call and decided in one of the configurations
+        was decided in a run up to the returned one.
+        """
+        mess = acceptor.ReadIndexMessage(node_id=NODE_ID, applied_run_id=self.applied_run_id(), group=self.group)
+        index = -1
+        for config in configs:
+            responses = self.broadcast(None, None, mess, acceptor.read_index,
+                                       lambda responses: len(responses) >= config.read_quorum, config.members)
+            if len(responses) < config.read_quorum:
+                self.log(None, None, "Quorum of nodes did not respond to read index message. Responses count: %s",
+                         len(responses))
+                raise HTTPException(status_code=503, detail="Service unavailable.")
+            index = max([index] + [r["run_id"] for r in responses])
+        return index
+
+    def read(self, ids: list, stale: bool = False) -> list:
+        """
+        Reads the accounts without running consensus. Linearizable unless stale is set,
+        in which case the local state is returned as it is.
+        """
+        if stale:
+            return self.learner.read(ids)
+        while True:
+            # A run decided in a configuration unknown here is preceded by the run deciding the configuration,
+            # which the read index covers. The read is repeated once that configuration is applied.
+            history = bank.tables[self.group].configurations
+            entries = history.entries
+            accounts = self.learner.read(ids, self.read_index(history.configurations_from(self.learner.run_id)))
+            if bank.tables[self.group].configurations.entries is entries:
+                return accounts
+
+    def prepare_leadership(self, run_id: int, propose_id: int, config: Configuration) -> dict:
+        """
+        Runs Phase 1 for every run >= run_id with the acceptors of config. On success this proposer becomes
+        the stable leader of the runs decided in config and the result for the given run is returned
+        in the per-run PROMISE format.
+        """
+        res = self.broadcast_prepare(run_id=run_id, propose_id=propose_id, config=config, range_prepare=True)
+        if "promised_id" in res:
+            return res
+
+        self.log(run_id, propose_id, "Became leader for runs >= %s.", run_id)
+        with self.lock:
+            self.leader_propose_id = propose_id
+            self.leader_run_id = run_id
+            self.leader_config = config
+            self.leader_accepted = res["accepted"]
+            return self.leader_accepted.get(run_id, {"accepted_id": -1, "accepted_val": None})
+
+    def leader_promise(self, run_id: int, config: Configuration):
+        """
+        Returns the leader propose id and the PROMISE for the run if Phase 1 was already won for it,
+        i.e. for a run at least leader_run_id decided in the same configuration. The PROMISE holds the value
+        already proposed in the run with the leader propose id, if any, which is the only one it may carry.
+        """
+        with self.lock:
+            if self.leader_propose_id is None or run_id < self.leader_run_id or config != self.leader_config:
+                return None, None
+            applied_run_id = self.learner.run_id
+            self.leader_accepted = {id: res for id, res in self.leader_accepted.items() if id >= applied_run_id}
+            return self.leader_propose_id, self.leader_accepted.get(run_id, {"accepted_id": -1, "accepted_val": None})
+
+    def leader_propose(self, run_id: int, propose_id: int, batch: bank.BankBatch):
+        """
+        Records the batch as the value of the run if propose_id is the leader propose id, before it is sent.
+        """
+        with self.lock:
+            if self.leader_propose_id == propose_id:
+                self.leader_accepted[run_id] = {"accepted_id": propose_id, "accepted_val": batch}
+
+    def leading(self, run_id: int) -> bool:
+        with self.lock:
+            return self.leader_propose_id is not None and run_id >= self.leader_run_id
+
+    def resign_leadership(self, propose_id: int):
+        with self.lock:
+            if self.leader_propose_id == propose_id:
+                self.leader_propose_id = None
+                self.leader_run_id = None
+                self.leader_config = None
+                self.leader_accepted = {}
+
+    @contextmanager
+    def run_lock(self, run_id: int):
+        with self.lock:
+            entry = self.run_locks.setdefault(run_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.run_locks[run_id]
+
+    def paxos(self, run_id: int, batch: bank.BankBatch, on_rejected=None) -> bank.BankBatch:
+        """
+        Runs consensus for the run and returns the decided batch, which may have been proposed by another node.
+        Operations of our batch that are invalid are dropped and reported with on_rejected({request_id: error}),
+        the run is decided even if none of them is left. Callers proposing the same run on this node take turns.
+        """
+        config = self.learner.configuration(run_id)
+        if config is None:
+            # The run was applied and its configuration forgotten since.
+            learned = self.learner.learned(run_id)
+            if learned is None:
+                raise HTTPException(status_code=503, detail="Service unavailable.")
+            return learned
+
+        with self.run_lock(run_id):
+            return self.run_paxos(run_id, batch, config, on_rejected)
+
+    def run_paxos(self, run_id: int, batch: bank.BankBatch, config: Configuration,
+                  on_rejected=None) -> bank.BankBatch:
+        def drop_invalid(batch: bank.BankBatch, errors: dict) -> bank.BankBatch:
+            if on_rejected is not None:
+                on_rejected({batch.ops[i].request_id: error for i, error in errors.items()})
+            return bank.BankBatch(ops=[op for i, op in enumerate(batch.ops) if i not in errors])
+
+        if FAST_PATH and batch.ops and bank.commutes(batch) and not self.leading(run_id):
+            batch = drop_invalid(batch, bank.validate_batch(batch, self.group))
+            if batch.ops and self.broadcast_accept(run_id, FAST_PROPOSE_ID, batch, config, config.fast_quorum):
+                self.log(run_id, FAST_PROPOSE_ID, "Batch %s was chosen in the fast round.", batch)
+                return batch
+            self.log(run_id, FAST_PROPOSE_ID, "Batch %s was not chosen in the fast round.", batch)
 
-    def paxos(self, op: bank.BankOperation) -> bank.BankOperation:
         propose_id = NODE_ID
         retries = 0
+        # Set once a node with a lower id preempted us, we then no longer try to take its leadership.
+        deferring = False
         while True:
-            self.log(propose_id, f"Proposing {op}")
-            res = self.broadcast_prepare(propose_id=propose_id)
+            learned = self.learner.learned(run_id)
+            if learned is not None:
+                self.log(run_id, propose_id, "Learned decided batch %s.", learned)
+                return learned
+
+            self.log(run_id, propose_id, "Proposing %s", batch)
+            leader_propose_id, res = self.leader_promise(run_id, config)
+            if leader_propose_id is not None:
+                # Phase 1 was already won for this run, skip straight to ACCEPT.
+                propose_id = leader_propose_id
+            elif MULTI_PAXOS and not deferring:
+                res = self.prepare_leadership(run_id=run_id, propose_id=propose_id, config=config)
+            else:
+                res = self.broadcast_prepare(run_id=run_id, propose_id=propose_id, config=config)
+
             if "promised_id" in res:
-                self.log(propose_id, f"Received NACK response {res}.")
+                self.log(run_id, propose_id, "Received NACK response %s.", res)
                 propose_id = next_unique(res["promised_id"])
-                backoff(retries)
+                deferring = deferring or (res.get("promised_by") or NODE_ID) < NODE_ID
+                self.backoff(run_id, propose_id, retries, res.get("promised_by"))
                 retries += 1
                 continue
             elif res["accepted_val"] is None:
-                self.log(propose_id, f"Majority of nodes have NOT accepted any value yet.")
-                bank.validate_without_executing(op)
-                pass
+                self.log(run_id, propose_id, "Majority of nodes have NOT accepted any value yet.")
+                errors = bank.validate_batch(batch, self.group)
+                if errors:
+                    if leader_propose_id is not None:
+                        # A preempted leader may be missing runs decided by others. Run Phase 1 before failing.
+                        self.log(run_id, propose_id, "Validation failed, confirming leadership.")
+                        self.resign_leadership(leader_propose_id)
+                        propose_id += MAX_NODES
+                        continue
+                    batch = drop_invalid(batch, errors)
+            elif res.get("merged"):
+                # Nothing was chosen in the fast round, commutative operations of every colliding proposer
+                # are decided together, ours too if they commute.
+                self.log(run_id, propose_id, "Merging fast round values: %s. ", res)
+                if bank.commutes(batch):
+                    batch = bank.merge_batches(res["accepted_val"], batch)
+                else:
+                    batch = bank.as_batch(res["accepted_val"])
             else:
-                self.log(propose_id, f"Majority of nodes accepted value: {res}. ")
-                op = bank.BankOperation(**res["accepted_val"])
+                self.log(run_id, propose_id, "Majority of nodes accepted value: %s. ", res)
+                batch = bank.as_batch(res["accepted_val"])
 
-            accepted = self.broadcast_accept(propose_id=propose_id, val=op)
+            # A propose id carries a single value per run, later proposals with the leader propose id reuse it.
+            self.leader_propose(run_id, propose_id, batch)
+            accepted = self.broadcast_accept(run_id=run_id, propose_id=propose_id, val=batch, config=config)
             if accepted:
-                self.log(propose_id, f"Operation {op} was accepted by majority of nodes.")
-                return op
+                self.log(run_id, propose_id, "Batch %s was accepted by a quorum of nodes.", batch)
+                return batch
             else:
-                self.log(propose_id, f"Operation {op} was NOT accepted by majority of nodes.")
-                propose_id += NODES
-                backoff(retries)
+                self.log(run_id, propose_id, "Batch %s was NOT accepted by a quorum of nodes.", batch)
+                if leader_propose_id is not None:
+                    self.log(run_id, propose_id, "Preempted by another proposer, falling back to per-run PREPARE.")
+                    self.resign_leadership(leader_propose_id)
+                propose_id += MAX_NODES
+                self.backoff(run_id, propose_id, retries)
                 retries += 1
 
-    def execute(self, my_op: bank.BankOperation) -> dict:
-        op = bank.BankOperation(op_type=None, args={})
-        res = {}
-        while op != my_op:
-            op = self.paxos(my_op.copy())
-            res = bank.execute(op, self.run_id)
-            self.run_id += 1
-            self.serialize()
-        return res
+    def backoff(self, run_id: int, propose_id: int, retries: int, promised_by: int = None):
+        """
+        Waits before retrying the run, returns early once the run is decided by the competing proposer.
+        """
+        delay = self.contention.delay(retries, promised_by)
+        self.log(run_id, propose_id, "Retrying after %.2f ms.", 1000 * delay)
+        self.learner.wait_learned(run_id, delay)
+
+    def allocate_run_id(self) -> int:
+        with self.lock:
+            self.next_run_id = max(self.next_run_id, self.learner.next_run_id()) + 1
+            return self.next_run_id - 1
+
+    def broadcast_decided(self, run_id: int, batch: bank.BankBatch):
+        """
+        Hands the decided batch to the local learner and announces it to the members without waiting for them.
+        """
+        self.learner.decide(run_id, batch)
+        mess = learner.DecidedMessage(run_id=run_id, val=batch, group=self.group)
+        for id in self.learner.members():
+            if id != NODE_ID:
+                executor.submit(self.send, run_id, None, id, "learner_decided", mess)
+
+    def fill_gap(self, run_id: int) -> bank.BankBatch:
+        """
+        Learns the batch decided in the run by proposing an empty one, which is decided if nothing else was.
+        """
+        batch = self.paxos(run_id, bank.BankBatch(ops=[]))
+        self.broadcast_decided(run_id, batch)
+        return batch
+
+    def batcher(self):
+        """
+        Takes a pipeline slot, collects the client operations arriving within the batching window
+        and hands them over to be committed as a single batch.
+        """
+        while True:
+            self.pipeline.acquire()
+            with self.pending_cond:
+                while not self.pending:
+                    self.pending_cond.wait()
+                deadline = time() + BATCH_WINDOW_MS / 1000
+                while len(self.pending) < BATCH_MAX_SIZE and time() < deadline:
+                    self.pending_cond.wait(deadline - time())
+                entries = self.pending[:BATCH_MAX_SIZE]
+                del self.pending[:BATCH_MAX_SIZE]
+            committer.submit(self.commit, entries)
+
+    def commit(self, entries: list):
+        """
+        Decides the operations of entries, a list of (operation, future), in a run of their own and resolves
+        every future with the result of its operation. Operations are matched to the decided batch by request id,
+        the ones missing from it, e.g. because another node's batch was decided in the run, are retried in the next one.
+        """
+        def reject(errors: dict):
+            for op, future in entries:
+                if op.request_id in errors:
+                    future.set_exception(errors[op.request_id])
+            entries[:] = [entry for entry in entries if entry[0].request_id not in errors]
+
+        slot_held = True
+        try:
+            while entries:
+                run_id = self.allocate_run_id()
+                self.learner.watch(run_id)
+                try:
+                    batch = self.paxos(run_id, bank.BankBatch(ops=[op.copy() for op, _ in entries]), reject)
+                except Exception:
+                    self.learner.unwatch(run_id)
+                    raise
+                self.broadcast_decided(run_id, batch)
+                decided = {op.request_id: i for i, op in enumerate(batch.ops)}
+                if not any(op.request_id in decided for op, _ in entries):
+                    self.learner.unwatch(run_id)
+                    continue
+
+                if slot_held:
+                    self.pipeline.release()
+                    slot_held = False
+                results = self.learner.wait_applied(run_id)
+                for op, future in entries:
+                    if op.request_id in decided:
+                        resolve(future, results[decided[op.request_id]])
+                entries[:] = [entry for entry in entries if entry[0].request_id not in decided]
+        except Exception as error:
+            for _, future in entries:
+                future.set_exception(error)
+        finally:
+            if slot_held:
+                self.pipeline.release()
+
+    def execute(self, my_op: bank.BankOperation) -> Future:
+        """
+        Executes the client operation, through the preferred proposer if it is enabled and is another node.
+        The returned future resolves to its result once it is applied.
+        """
+        if PREFERRED_PROPOSER:
+            preferred = self.failure_detector.preferred()
+            if preferred != NODE_ID:
+                return forwarder.submit(self.forward, preferred, my_op)
+        return self.propose(my_op)
+
+    def forward(self, id: int, my_op: bank.BankOperation) -> dict:
+        """
+        Executes the operation through the given node. Proposes it here instead if the node cannot be reached.
+        """
+        try:
+            return transport.get_peer(id).put("forward", my_op.dict())
+        except requests.HTTPError as error:
+            # The node executed the operation, but it failed, e.g. for insufficient funds.
+            try:
+                detail = error.response.json()["detail"]
+            except (ValueError, KeyError):
+                detail = error.response.text
+            raise HTTPException(status_code=error.response.status_code, detail=detail)
+        except Exception as error:
+            if not transport.not_delivered(error):
+                # The node may still execute the operation, proposing it again could apply it twice.
+                logger.debug("Forwarding %s to node %s failed. Reason: %s", my_op, id, error)
+                raise HTTPException(status_code=503, detail="Service unavailable.")
+        logger.debug("Node %s is unreachable, proposing %s here.", id, my_op)
+        return self.propose(my_op).result()
+
+    def propose(self, my_op: bank.BankOperation) -> Future:
+        """
+        Queues the operation for the next batch. The returned future resolves to its result once it is applied.
+        Retries of a request that is still being decided share its future, retries of a recently applied one
+        get its result without running consensus again.
+        """
+        with self.pending_cond:
+            # Requests leave in_flight only after being applied, so they are looked up there first.
+            if my_op.request_id in self.in_flight:
+                return self.in_flight[my_op.request_id]
+            future = Future()
+            found, res = bank.applied_result(my_op.request_id, self.group)
+            if found:
+                resolve(future, res)
+                return future
+
+            # Running futures cannot be cancelled, one client giving up must not cancel a shared future.
+            future.set_running_or_notify_cancel()
+            self.in_flight[my_op.request_id] = future
+            future.add_done_callback(lambda _: self.forget(my_op.request_id))
+            self.pending.append((my_op, future))
+            self.pending_cond.notify()
+        return future
+
+    def forget(self, request_id: str):
+        with self.pending_cond:
+            self.in_flight.pop(request_id, None)
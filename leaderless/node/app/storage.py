@@ -0,0 +1,138 @@
+import abc
+import os
+import sqlite3
+import threading
+
+# Where a node keeps the checkpoints of its account table: "postgres", its own database on the server
+# configured in database.ini, or "sqlite", an embedded database file next to the node's logs and WAL.
+BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+# Database file of the sqlite backend.
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bank.db")
+
+
+class Storage(abc.ABC):
+    """
+    Durable checkpoints of the account tables of the groups. A checkpoint of a group is written in a single
+    transaction: the accounts changed and removed since the previous one and the state of the group (the run
+    it was applied up to, the results of its recent requests, its pending transfers and its configurations,
+    the latter three as JSON).
+    """
+
+    @abc.abstractmethod
+    def load(self, group: int) -> tuple:
+        """
+        Returns a list of (id, balance) of every account and (run_id, requests, transfers, configurations)
+        of the group, None if the group was never checkpointed.
+        """
+
+    @abc.abstractmethod
+    def save(self, group: int, run_id: int, ids: list, balances: list, deleted: list, requests: str,
+             transfers: str, configurations: str):
+        """
+        Writes the checkpoint of the group in a single transaction.
+        """
+
+
+class PostgresStorage(Storage):
+    # Server-side prepared statements, created on every new connection. Accounts are passed as arrays,
+    # so that any number of them is written with a single statement.
+    STATEMENTS = [
+        "PREPARE upsert_accounts (varchar[], integer[]) AS "
+        "INSERT INTO accounts(id, balance) SELECT * FROM unnest($1, $2) "
+        "ON CONFLICT (id) DO UPDATE SET balance = EXCLUDED.balance;",
+        "PREPARE delete_accounts (varchar[]) AS DELETE FROM accounts WHERE id = ANY($1);",
+        "PREPARE save_applied_run (integer, integer, text, text, text) AS "
+        "INSERT INTO applied_run(id, run_id, requests, transfers, configurations) VALUES ($1, $2, $3, $4, $5) "
+        "ON CONFLICT (id) DO UPDATE SET run_id = EXCLUDED.run_id, requests = EXCLUDED.requests, "
+        "transfers = EXCLUDED.transfers, configurations = EXCLUDED.configurations;",
+    ]
+    # Brings databases of nodes from before checkpoints, request ids, groups and reconfigurations up to date.
+    MIGRATIONS = [
+        "CREATE TABLE IF NOT EXISTS applied_run (id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL);",
+        "ALTER TABLE applied_run ADD COLUMN IF NOT EXISTS requests TEXT;",
+        "ALTER TABLE applied_run ADD COLUMN IF NOT EXISTS transfers TEXT;",
+        "ALTER TABLE applied_run ADD COLUMN IF NOT EXISTS configurations TEXT;",
+    ]
+
+    def __init__(self):
+        # Imported here, so that nodes using the embedded backend do not need psycopg2.
+        import database as database
+        self.database = database
+        self.db = database.ConnectionPool(database.POOL_SIZE, on_connect=self.prepare_statements)
+
+    def prepare_statements(self, conn):
+        with conn.cursor() as cur:
+            for statement in self.MIGRATIONS + self.STATEMENTS:
+                self.database.write_query(cur, statement)
+        conn.commit()
+
+    def load(self, group: int) -> tuple:
+        with self.db.connection() as conn, conn.cursor() as cur:
+            accounts = self.database.read_query(cur, "SELECT id, balance FROM accounts;")
+            run = self.database.read_query(
+                cur, "SELECT run_id, requests, transfers, configurations FROM applied_run WHERE id = %s;",
+                (group + 1,))
+            conn.rollback()
+        return accounts, run[0] if run else None
+
+    def save(self, group: int, run_id: int, ids: list, balances: list, deleted: list, requests: str,
+             transfers: str, configurations: str):
+        with self.db.connection() as conn, conn.cursor() as cur:
+            if deleted:
+                self.database.write_query(cur, "EXECUTE delete_accounts (%s);", (deleted,))
+            self.database.write_query(cur, "EXECUTE upsert_accounts (%s, %s);", (ids, balances))
+            self.database.write_query(cur, "EXECUTE save_applied_run (%s, %s, %s, %s, %s);",
+                                      (group + 1, run_id, requests, transfers, configurations))
+            conn.commit()
+
+
+class SqliteStorage(Storage):
+    """
+    Embedded backend without a database server, the tables are created on first use. The database runs in
+    WAL mode, so that loading a group does not wait for a checkpoint being written, and commits are synced
+    to disk like the Postgres ones.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS accounts (id VARCHAR(50) PRIMARY KEY, balance INTEGER NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS applied_run (id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL, requests TEXT, "
+        "transfers TEXT, configurations TEXT);",
+    ]
+
+    def __init__(self, path: str = SQLITE_PATH):
+        # Checkpoints are written by a single thread at a time, one connection shared under a lock is enough.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=FULL;")
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def load(self, group: int) -> tuple:
+        with self.lock:
+            accounts = self.conn.execute("SELECT id, balance FROM accounts;").fetchall()
+            run = self.conn.execute("SELECT run_id, requests, transfers, configurations FROM applied_run "
+                                    "WHERE id = ?;", (group + 1,)).fetchone()
+        return accounts, run
+
+    def save(self, group: int, run_id: int, ids: list, balances: list, deleted: list, requests: str,
+             transfers: str, configurations: str):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM accounts WHERE id = ?;", [(id,) for id in deleted])
+            self.conn.executemany("INSERT INTO accounts(id, balance) VALUES (?, ?) "
+                                  "ON CONFLICT (id) DO UPDATE SET balance = excluded.balance;", zip(ids, balances))
+            self.conn.execute("INSERT INTO applied_run(id, run_id, requests, transfers, configurations) "
+                              "VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET run_id = excluded.run_id, "
+                              "requests = excluded.requests, transfers = excluded.transfers, "
+                              "configurations = excluded.configurations;",
+                              (group + 1, run_id, requests, transfers, configurations))
+
+
+BACKENDS = {"postgres": PostgresStorage, "sqlite": SqliteStorage}
+
+
+def open_storage() -> Storage:
+    if BACKEND not in BACKENDS:
+        raise ValueError(f"STORAGE_BACKEND {BACKEND} is not one of {', '.join(BACKENDS)}!")
+    return BACKENDS[BACKEND]()
@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The node modules read their configuration from the environment on import and keep their state files, logs
+# and checkpoints in the working directory. Tests run node 1 of a single node cluster in a scratch directory,
+# with an embedded database.
+os.environ.update({
+    "NODE_ID": "1",
+    "NODES": "1",
+    "STORAGE_BACKEND": "sqlite",
+    "LOG_CONSOLE": "0",
+})
+os.chdir(tempfile.mkdtemp(prefix="leaderless-tests-"))
+sys.path.insert(0, APP_DIR)
+
+import bank
+
+
+def batch(*request_ids, op_type: bank.BankOpType = bank.BankOpType.DEPOSIT) -> bank.BankBatch:
+    """
+    Batch of an operation per request id. Deposits go to an account that does not exist, so that they fail
+    on every node without touching the bank.
+    """
+    args = {"id": "missing", "amount": 5} if op_type == bank.BankOpType.DEPOSIT else {}
+    return bank.BankBatch(ops=[bank.BankOperation(op_type=op_type, args=dict(args), request_id=request_id)
+                               for request_id in request_ids])
@@ -0,0 +1,63 @@
+import os
+import pickle
+from collections import defaultdict
+
+import pytest
+
+import acceptor
+import bank
+from conftest import batch
+
+
+def deposit() -> bank.BankOperation:
+    return batch("deposit").ops[0]
+
+
+def test_state_pickled_before_the_wal_is_recovered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    on_disk_acceptor = acceptor.Acceptor.__new__(acceptor.Acceptor)
+    on_disk_acceptor.parameters = defaultdict(acceptor.create_default_params,
+                                              {3: {"promised_id": 11, "accepted_id": 6, "accepted_val": deposit()}})
+    with open(acceptor.LEGACY_FILE_NAME, "wb") as outfile:
+        pickle.dump(on_disk_acceptor, outfile)
+
+    instance = acceptor.Acceptor()
+    # The state lives in the snapshot from now on.
+    os.remove(acceptor.LEGACY_FILE_NAME)
+    for instance in (instance, acceptor.Acceptor()):
+        params = instance.parameters[3]
+        assert (params.promised_id, params.accepted_id) == (11, 6)
+        assert instance.accepted_val(params).ops[0].args == deposit().args
+
+
+def test_runs_applied_by_every_node_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    instance = acceptor.Acceptor()
+    low_water_mark = acceptor.GC_EVERY + 5
+    for run_id in range(low_water_mark + 5):
+        instance.persist(("accept", run_id, 1, batch("deposit").to_tuple()))
+
+    # Nodes that do not propose report the runs they applied periodically.
+    for node_id in bank.tables[0].configurations.members_from(0):
+        assert instance.low_water_mark == 0
+        instance.handle(acceptor.AppliedMessage(node_id=node_id, applied_run_id=low_water_mark), lambda: None)
+    assert instance.low_water_mark == low_water_mark
+    assert min(instance.parameters) == low_water_mark
+
+    recovered = acceptor.Acceptor()
+    assert recovered.low_water_mark == low_water_mark
+    assert sorted(recovered.parameters) == list(range(low_water_mark, low_water_mark + 5))
+
+
+def test_groups_keep_separate_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(acceptor, "instances", [acceptor.Acceptor(0), acceptor.Acceptor(1)])
+    acceptor.accept(acceptor.AcceptMessage(run_id=0, propose_id=1, val=batch("deposit"), group=1))
+    assert 0 in acceptor.instances[1].parameters
+    assert 0 not in acceptor.instances[0].parameters
+    assert acceptor.acceptor_stats(group=1)["runs"] == 1
+
+    # Groups the node does not run are not found rather than failing the node.
+    with pytest.raises(acceptor.HTTPException) as error:
+        acceptor.acceptor_stats(group=2)
+    assert error.value.status_code == 404
@@ -0,0 +1,147 @@
+import pickle
+
+import pytest
+
+import bank
+import cluster
+
+
+@pytest.fixture
+def state(monkeypatch):
+    state = bank.AccountTable(0)
+    monkeypatch.setattr(bank, "tables", [state])
+    return state
+
+
+@pytest.fixture
+def groups(monkeypatch):
+    """
+    Tables of two groups, holding account "a" in group 0 and account "b.1" in group 1.
+    """
+    monkeypatch.setattr(cluster, "GROUPS", 2)
+    tables = [bank.AccountTable(0), bank.AccountTable(1)]
+    monkeypatch.setattr(bank, "tables", tables)
+    tables[0].balances["a"] = 10
+    tables[1].balances["b.1"] = 0
+    return tables
+
+
+def operation(op_type: bank.BankOpType, **args) -> bank.BankOperation:
+    return bank.BankOperation(op_type=op_type, args=args)
+
+
+def test_batch_is_checkpointed_with_its_run(state):
+    batch = bank.BankBatch(ops=[operation(bank.BankOpType.OPEN_ACCOUNT),
+                                operation(bank.BankOpType.DEPOSIT, id="4-0", amount=10),
+                                operation(bank.BankOpType.WITHDRAW, id="4-0", amount=20)])
+    results = bank.execute_batch(batch, 4)
+    assert results[1] == {"id": "4-0", "balance": 10}
+    assert results[2].status_code == 403
+    assert state.run_id == 5
+
+    state.checkpoint()
+    loaded = bank.AccountTable(0)
+    loaded.load()
+    assert loaded.balances["4-0"] == 10
+    assert loaded.run_id == 5
+
+
+def test_applied_run_is_taken_over_from_state_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert bank.load_legacy_run_id() == 0
+    with open("proposer.pickle", "wb") as outfile:
+        pickle.dump({"run_id": 7}, outfile)
+    assert bank.load_legacy_run_id() == 7
+    with open("learner.pickle", "wb") as outfile:
+        pickle.dump({"run_id": 9}, outfile)
+    assert bank.load_legacy_run_id() == 9
+
+
+def test_request_decided_twice_is_applied_once(state):
+    bank.execute_batch(bank.BankBatch(ops=[operation(bank.BankOpType.OPEN_ACCOUNT)]), 0)
+    deposit = operation(bank.BankOpType.DEPOSIT, id="0-0", amount=10)
+    first = bank.execute_batch(bank.BankBatch(ops=[deposit]), 1)
+    # E.g. the client retried the request on another node, which decided it in a later run.
+    retry = bank.BankOperation(op_type=deposit.op_type, args=deposit.args, node_id=2, request_id=deposit.request_id)
+    assert bank.execute_batch(bank.BankBatch(ops=[retry]), 2) == first
+    assert state.balances["0-0"] == 10
+    assert bank.applied_result(deposit.request_id) == (True, first[0])
+    assert bank.validate_batch(bank.BankBatch(ops=[retry])) == {}
+
+
+def test_applied_requests_are_replicated_state(state):
+    withdraw = operation(bank.BankOpType.WITHDRAW, id="missing", amount=10)
+    bank.execute_batch(bank.BankBatch(ops=[operation(bank.BankOpType.OPEN_ACCOUNT), withdraw]), 6)
+    state.checkpoint()
+    loaded = bank.AccountTable(0)
+    loaded.load()
+    assert loaded.dump_requests() == state.dump_requests()
+    assert loaded.requests[withdraw.request_id].status_code == 404
+
+    accounts, requests, transfers, configurations = bank.dump_accounts()
+    bank.restore_accounts(accounts, 7, 0, requests, transfers, configurations)
+    assert bank.applied_result(withdraw.request_id)[1].status_code == 404
+
+
+def test_oldest_requests_are_forgotten(state, monkeypatch):
+    monkeypatch.setattr(bank, "DEDUP_SIZE", 2)
+    ops = [operation(bank.BankOpType.OPEN_ACCOUNT) for _ in range(3)]
+    bank.execute_batch(bank.BankBatch(ops=ops), 0)
+    assert list(state.requests) == [op.request_id for op in ops[1:]]
+
+
+def step(op_type: bank.BankOpType, **args) -> bank.BankBatch:
+    return bank.BankBatch(ops=[operation(op_type, transfer_id="t", **args)])
+
+
+def test_transfer_steps_decided_twice_are_applied_once(groups):
+    for run_id in (0, 1):
+        # Every decision of a step carries a new request id, e.g. when recovery completes the transfer.
+        bank.execute_batch(step(bank.BankOpType.TRANSFER_OUT, from_id="a", to_id="b.1", amount=4), run_id, 0)
+        bank.execute_batch(step(bank.BankOpType.TRANSFER_IN, to_id="b.1", amount=4), run_id, 1)
+    assert (groups[0].balances["a"], groups[1].balances["b.1"]) == (6, 4)
+    assert groups[0].outgoing == {"t": ("b.1", 4)}
+
+    bank.execute_batch(step(bank.BankOpType.TRANSFER_DONE, group=0), 2, 0)
+    assert groups[0].outgoing == {}
+
+
+def test_failed_credit_is_decided_again(groups):
+    missing = step(bank.BankOpType.TRANSFER_IN, to_id="c.1", amount=4)
+    assert bank.execute_batch(missing, 0, 1)[0].status_code == 404
+    groups[1].balances["c.1"] = 0
+    bank.execute_batch(step(bank.BankOpType.TRANSFER_IN, to_id="c.1", amount=4), 1, 1)
+    assert groups[1].balances["c.1"] == 4
+
+
+def test_debits_of_outgoing_transfers_are_not_forgotten(groups, monkeypatch):
+    monkeypatch.setattr(bank, "TRANSFER_DEDUP_SIZE", 1)
+    bank.execute_batch(step(bank.BankOpType.TRANSFER_OUT, from_id="a", to_id="b.1", amount=4), 0, 0)
+    for run_id in range(1, 3):
+        bank.execute_batch(bank.BankBatch(ops=[operation(bank.BankOpType.TRANSFER_IN, to_id="a", amount=1,
+                                                         transfer_id=f"in-{run_id}")]), run_id, 0)
+    assert list(groups[0].applied_steps) == ["out:t", "in:in-2"]
+    # Recovery decides the debit again while the transfer is outgoing.
+    bank.execute_batch(step(bank.BankOpType.TRANSFER_OUT, from_id="a", to_id="b.1", amount=4), 3, 0)
+    assert groups[0].balances["a"] == 8
+
+
+def test_operation_on_an_account_of_another_group_fails(groups):
+    deposit = bank.BankBatch(ops=[operation(bank.BankOpType.DEPOSIT, id="b.1", amount=1)])
+    assert bank.execute_batch(deposit, 0, 0)[0].status_code == 400
+    assert groups[1].balances["b.1"] == 0
+
+
+def test_groups_are_checkpointed_separately(groups):
+    bank.execute_batch(step(bank.BankOpType.TRANSFER_OUT, from_id="a", to_id="b.1", amount=4), 5, 0)
+    bank.execute_batch(bank.BankBatch(ops=[]), 2, 1)
+    for table in groups:
+        table.checkpoint()
+    loaded = [bank.AccountTable(0), bank.AccountTable(1)]
+    for table in loaded:
+        table.load()
+    assert [table.run_id for table in loaded] == [6, 3]
+    assert loaded[0].balances["a"] == 6
+    assert "a" not in loaded[1].balances
+    assert loaded[0].outgoing == {"t": ("b.1", 4)}
+    assert loaded[0].dump_requests() == groups[0].dump_requests()
@@ -0,0 +1,56 @@
+import pytest
+
+import configuration
+from configuration import Configuration, History
+
+
+def members(n: int) -> dict:
+    return {id: f"node{id}:80" for id in range(1, n + 1)}
+
+
+def test_quorums_default_to_a_majority():
+    config = Configuration(members(5))
+    assert (config.phase1_quorum, config.phase2_quorum) == (3, 3)
+    assert config.read_quorum == 3
+    assert config.fast_quorum == 4
+
+
+@pytest.mark.parametrize("n, phase1_quorum, phase2_quorum", [(5, 3, 3), (5, 4, 2), (5, 2, 4), (5, 3, 5), (4, 3, 2)])
+@pytest.mark.parametrize("fast_path", [False, True])
+def test_quorums_intersect(monkeypatch, n, phase1_quorum, phase2_quorum, fast_path):
+    monkeypatch.setattr(configuration, "FAST_PATH", fast_path)
+    config = Configuration(members(n), phase1_quorum, phase2_quorum)
+    config.validate()
+    assert config.phase1_quorum + config.phase2_quorum > n
+    # Any two fast quorums and a Phase 1 quorum share an acceptor.
+    assert 2 * config.fast_quorum + config.phase1_quorum > 2 * n
+    # A read quorum sees every value chosen in Phase 2 and, with the fast path, in the fast round.
+    assert config.read_quorum + config.phase2_quorum > n
+    if fast_path:
+        assert config.read_quorum + config.fast_quorum > n
+
+
+@pytest.mark.parametrize("phase1_quorum, phase2_quorum", [(2, 3), (6, 3), (3, -1)])
+def test_validate_rejects_disjoint_quorums(phase1_quorum, phase2_quorum):
+    with pytest.raises(ValueError):
+        Configuration(members(5), phase1_quorum, phase2_quorum).validate()
+
+
+def test_validate_rejects_node_ids_above_max_nodes():
+    with pytest.raises(ValueError):
+        Configuration({configuration.MAX_NODES + 1: "node:80"}).validate()
+
+
+def test_history_switches_configuration_at_its_first_run():
+    old, new = Configuration(members(3)), Configuration({1: "node1:80", 2: "node2:80", 4: "node4:80"})
+    history = History([(0, old)])
+    history.add(10 + configuration.WINDOW, new, 10)
+    assert history.at(10 + configuration.WINDOW - 1) == old
+    assert history.at(10 + configuration.WINDOW) == new
+    assert history.members_from(10) == {1, 2, 3, 4}
+    assert history.configurations_from(10 + configuration.WINDOW) == [new]
+
+    # Once the new configuration is in effect for the run applied, the old one is forgotten.
+    history.add(20 + configuration.WINDOW, new, 10 + configuration.WINDOW)
+    assert history.at(0) is None
+    assert History.from_list(history.to_list()).to_list() == history.to_list()
@@ -0,0 +1,153 @@
+import json
+import threading
+
+import pytest
+
+import bank
+import learner
+import transport
+from configuration import History
+from conftest import batch
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(learner, "GAP_TIMEOUT_MS", 50)
+    monkeypatch.setattr(bank, "tables", [bank.AccountTable(0)])
+    return tmp_path
+
+
+def start(gap_batches: dict = None) -> learner.Learner:
+    instance = learner.Learner()
+    filled = threading.Event()
+
+    def fill_gap(run_id):
+        filled.set()
+        return gap_batches[run_id]
+
+    instance.start(fill_gap)
+    instance.filled = filled
+    return instance
+
+
+def test_runs_are_applied_in_order(state_dir):
+    instance = start()
+    instance.watch(0)
+    instance.watch(1)
+    instance.decide(1, batch("deposit-2"))
+    assert instance.learned(1) == batch("deposit-2")
+    instance.decide(0, batch("deposit-1"))
+
+    assert [error.status_code for error in instance.wait_applied(0)] == [404]
+    assert [error.status_code for error in instance.wait_applied(1)] == [404]
+    assert learner.Learner().run_id == 2
+
+
+def test_undecided_run_is_learned(state_dir):
+    instance = start({0: bank.BankBatch(ops=[])})
+    instance.watch(1)
+    instance.decide(1, batch("deposit-1"))
+
+    assert len(instance.wait_applied(1)) == 1
+    assert instance.filled.is_set()
+    assert instance.next_run_id() == 2
+
+
+def test_decided_batch_is_not_replaced(state_dir):
+    instance = learner.Learner()
+    instance.decide(0, batch("deposit-1"))
+    instance.decide(0, batch("deposit-2"))
+    assert instance.learned(0) == batch("deposit-1")
+
+
+def applied(runs: int) -> learner.Learner:
+    instance = learner.Learner()
+    with instance.cond:
+        for run_id in range(runs):
+            instance.decide_locked(run_id, batch(f"deposit-{run_id + 1}"))
+        instance.apply_ready()
+    return instance
+
+
+class Peer:
+    """
+    Serves the catch-up stream of a learner in the same process.
+    """
+
+    def __init__(self, source: learner.Learner):
+        self.source = source
+
+    def stream(self, endpoint: str, params: dict):
+        for line in self.source.catch_up_stream(params["from_run_id"]):
+            yield json.loads(line)
+
+
+def test_retained_runs_are_streamed_in_chunks(state_dir, monkeypatch):
+    monkeypatch.setattr(learner, "CATCHUP_CHUNK_RUNS", 2)
+    source = applied(5)
+    lines = [json.loads(line) for line in source.catch_up_stream(1)]
+    assert [[run_id for run_id, _ in line["runs"]] for line in lines] == [[1, 2], [3, 4]]
+
+
+def test_lagging_node_catches_up_from_a_peer(state_dir, monkeypatch):
+    # Both learners apply runs to the same bank, the target starts from it first.
+    target = learner.Learner()
+    source = applied(3)
+    monkeypatch.setattr(target, "members", lambda: {1, 2})
+    monkeypatch.setattr(transport, "get_peer", lambda id: Peer(source))
+
+    assert target.catch_up()
+    assert target.run_id == 3
+    assert target.retained[2] == batch("deposit-3").to_tuple()
+
+
+def test_snapshot_is_installed_when_runs_are_no_longer_retained(state_dir, monkeypatch):
+    monkeypatch.setattr(learner, "RETAIN_RUNS", 1)
+    target = learner.Learner()
+    source = applied(3)
+    lines = [json.loads(line) for line in source.catch_up_stream(0)]
+    assert [line["snapshot"]["run_id"] for line in lines] == [3]
+
+    restored = []
+    monkeypatch.setattr(bank, "restore_accounts", lambda *state: restored.append(state))
+    monkeypatch.setattr(target, "members", lambda: {1, 2})
+    monkeypatch.setattr(transport, "get_peer", lambda id: Peer(source))
+    target.watch(1)
+
+    assert target.catch_up()
+    assert target.run_id == 3
+    accounts, run_id, group, requests, transfers, configurations = restored[0]
+    assert accounts == [tuple(account) for account in lines[0]["snapshot"]["accounts"]]
+    # Results of applied requests travel with the snapshot, so that their retries are not applied again.
+    assert [request_id for request_id, _ in requests] == ["deposit-1", "deposit-2", "deposit-3"]
+    assert transfers == {"outgoing": {}, "applied_steps": []}
+    assert History.from_list(configurations).to_list() == bank.tables[0].configurations.to_list()
+    # The results of runs skipped by the snapshot are unknown.
+    with pytest.raises(learner.HTTPException) as error:
+        target.wait_applied(1)
+    assert error.value.status_code == 503
+
+
+def test_read_learns_runs_up_to_its_read_index(state_dir):
+    instance = start({0: bank.BankBatch(ops=[])})
+    # No later run is decided, the read alone makes the learner fill the gap.
+    with pytest.raises(learner.HTTPException) as error:
+        instance.read(["missing"], 0)
+    assert error.value.status_code == 404
+    assert instance.filled.is_set()
+    assert instance.run_id == 1
+
+
+def test_read_times_out_while_runs_are_missing(state_dir, monkeypatch):
+    monkeypatch.setattr(learner, "READ_TIMEOUT_MS", 50)
+    instance = learner.Learner()
+    with pytest.raises(learner.HTTPException) as error:
+        instance.read(["missing"], 0)
+    assert error.value.status_code == 503
+
+
+def test_unknown_group_is_not_found():
+    with pytest.raises(learner.HTTPException) as error:
+        learner.instance_of(len(learner.instances))
+    assert error.value.status_code == 404
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+import bank
+import proposer
+from configuration import Configuration
+from conftest import batch
+
+CONFIG = Configuration({id: f"node{id}:80" for id in range(1, 6)})
+
+
+def open_batch(*request_ids) -> bank.BankBatch:
+    return batch(*request_ids, op_type=bank.BankOpType.OPEN_ACCOUNT)
+
+
+def test_choose_value_keeps_highest_classic_value():
+    promises = [{"accepted_id": 0, "accepted_val": batch("fast")}, {"accepted_id": 7, "accepted_val": batch("a")},
+                {"accepted_id": 12, "accepted_val": batch("b")}]
+    assert proposer.choose_value(promises, 3, CONFIG)["accepted_val"] == batch("b")
+
+
+def test_choose_value_reproposes_fast_value_that_may_have_been_chosen():
+    # 2 of 3 answering acceptors voted for it, with the 2 silent ones it may have reached the fast quorum of 4.
+    promises = [{"accepted_id": 0, "accepted_val": batch("a")}, {"accepted_id": 0, "accepted_val": batch("a")},
+                {"accepted_id": 0, "accepted_val": batch("b")}]
+    res = proposer.choose_value(promises, 3, CONFIG)
+    assert res["accepted_val"] == batch("a")
+    assert not res.get("merged")
+
+
+def test_choose_value_merges_fast_values_that_were_not_chosen():
+    promises = [{"accepted_id": 0, "accepted_val": batch("a")}, {"accepted_id": 0, "accepted_val": batch("b")},
+                {"accepted_id": 0, "accepted_val": batch("a", "c")}]
+    res = proposer.choose_value(promises, 4, CONFIG)
+    assert res["merged"]
+    assert [op.request_id for op in res["accepted_val"].ops] == ["a", "b", "c"]
+
+
+@pytest.fixture
+def leader(monkeypatch):
+    """
+    Multi-Paxos proposer of a single node cluster, deciding runs with the local acceptor only.
+    """
+    monkeypatch.setattr(proposer, "MULTI_PAXOS", True)
+    return proposer.Proposer()
+
+
+def test_leader_proposes_a_single_value_per_run(leader):
+    run_id = leader.allocate_run_id()
+    first = open_batch("first")
+    assert leader.paxos(run_id, first) == first
+    assert leader.leader_propose_id is not None
+    # E.g. the run was released after its ACCEPT was sent and is reused by another request.
+    assert leader.paxos(run_id, open_batch("second")) == first
+
+
+def test_concurrent_proposals_of_a_run_decide_one_value(leader):
+    run_id = leader.allocate_run_id()
+    barrier = threading.Barrier(2)
+    decided = {}
+
+    def propose(node_id):
+        barrier.wait()
+        decided[node_id] = leader.paxos(run_id, open_batch(f"client-{node_id}"))
+
+    threads = [threading.Thread(target=propose, args=(node_id,)) for node_id in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert decided[1] == decided[2]
+
+
+def test_read_index_covers_decided_runs(leader):
+    run_id = leader.allocate_run_id()
+    leader.paxos(run_id, open_batch("first"))
+    config = leader.learner.configuration(run_id)
+    assert leader.read_index([config]) >= run_id
+
+
+def test_retry_of_a_request_applied_elsewhere_is_answered_from_the_bank(leader, monkeypatch):
+    monkeypatch.setattr(bank, "tables", [bank.AccountTable(0)])
+    opened = open_batch("opened")
+    # The request was first sent to node 2, which decided it in a run this node has applied since.
+    res = bank.execute_batch(opened, 0)[0]
+    retry = bank.BankOperation(op_type=bank.BankOpType.OPEN_ACCOUNT, args={}, request_id=opened.ops[0].request_id)
+    assert leader.propose(retry).result(timeout=1) == res
+    assert leader.pending == []
@@ -0,0 +1,41 @@
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def sqlite(tmp_path) -> storage.SqliteStorage:
+    return storage.SqliteStorage(str(tmp_path / "bank.db"))
+
+
+def test_sqlite_checkpoints_groups_in_their_own_rows(sqlite):
+    assert sqlite.load(1) == ([], None)
+    sqlite.save(0, 4, ["a", "b"], [10, 20], [], "[]", "{}", "[]")
+    sqlite.save(1, 9, ["c.1"], [5], [], '[["r", {}]]', "{}", "[]")
+    sqlite.save(0, 6, ["a"], [15], ["b"], "[]", "{}", "[]")
+
+    accounts, run = sqlite.load(1)
+    assert sorted(accounts) == [("a", 15), ("c.1", 5)]
+    assert run == (9, '[["r", {}]]', "{}", "[]")
+    assert sqlite.load(0)[1][0] == 6
+
+
+def test_checkpoints_survive_a_restart(tmp_path):
+    path = str(tmp_path / "bank.db")
+    storage.SqliteStorage(path).save(0, 3, ["a"], [7], [], "[]", "{}", "[]")
+    assert storage.SqliteStorage(path).load(0) == ([("a", 7)], (3, "[]", "{}", "[]"))
+
+
+def test_backend_has_to_implement_load_and_save():
+    class Incomplete(storage.Storage):
+        def load(self, group: int) -> tuple:
+            return [], None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_unknown_backend_is_rejected(monkeypatch):
+    monkeypatch.setattr(storage, "BACKEND", "mmap")
+    with pytest.raises(ValueError):
+        storage.open_storage()
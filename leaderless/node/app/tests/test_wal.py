@@ -0,0 +1,50 @@
+import threading
+
+import wal
+from wal import WriteAheadLog
+
+
+def test_recover_replays_records_after_snapshot(tmp_path):
+    log = WriteAheadLog(str(tmp_path / "log"), snapshot_every=10)
+    assert log.recover() == (None, [])
+    log.wait_durable(log.append(("promise", 1)))
+    log.snapshot({"state": 1})
+    log.wait_durable(log.append(("accept", 2)))
+    log.wait_durable(log.append(("accept", 3)))
+
+    snapshot, records = WriteAheadLog(str(tmp_path / "log"), snapshot_every=10).recover()
+    assert snapshot == {"state": 1}
+    assert records == [("accept", 2), ("accept", 3)]
+
+
+def test_recover_cuts_off_torn_tail(tmp_path):
+    log = WriteAheadLog(str(tmp_path / "log"), snapshot_every=10)
+    log.recover()
+    log.wait_durable(log.append("first"))
+    log.wait_durable(log.append("second"))
+    size = (tmp_path / "log.wal").stat().st_size
+    with open(tmp_path / "log.wal", "r+b") as file:
+        file.truncate(size - 1)
+
+    recovered = WriteAheadLog(str(tmp_path / "log"), snapshot_every=10)
+    assert recovered.recover() == (None, ["first"])
+    recovered.wait_durable(recovered.append("third"))
+    assert WriteAheadLog(str(tmp_path / "log"), snapshot_every=10).recover() == (None, ["first", "third"])
+
+
+def test_group_commit_shares_fsyncs(tmp_path, monkeypatch):
+    fsyncs = []
+    fsync = wal.os.fsync
+    monkeypatch.setattr(wal.os, "fsync", lambda fd: (fsyncs.append(fd), fsync(fd)))
+    log = WriteAheadLog(str(tmp_path / "log"), snapshot_every=1000, group_commit_delay=0.05)
+    log.recover()
+
+    threads = [threading.Thread(target=lambda i=i: log.wait_durable(log.append(i))) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert log.durable_seq == 20
+    assert len(fsyncs) < 20
+    assert sorted(WriteAheadLog(str(tmp_path / "log"), snapshot_every=1000).recover()[1]) == list(range(20))
@@ -0,0 +1,28 @@
+import bank
+import wire
+from conftest import batch
+
+
+def test_requests_round_trip():
+    messages = [
+        (wire.PREPARE, 0, 7, 17, True, 1, 3),
+        (wire.ACCEPT, 1, 8, 33, batch("a", "b"), None, None),
+        (wire.ACCEPT, 0, 9, 0, bank.BankBatch(ops=[]), 2, 0),
+        (wire.READ_INDEX, 2, 3, 5),
+        (wire.APPLIED, 1, 2, 6),
+    ]
+    assert wire.decode_requests(wire.encode_requests(messages)) == messages
+
+
+def test_responses_round_trip():
+    responses = [
+        {"promised_id": 49, "promised_by": 1},
+        {"promised_id": -1, "promised_by": None},
+        {"accepted_id": -1, "accepted_val": None},
+        {"accepted_id": 17, "accepted_val": batch("a")},
+        {"accepted": [{"run_id": 4, "accepted_id": 0, "accepted_val": batch("b", "c")}]},
+        {"accepted": True},
+        {"run_id": 12},
+        {},
+    ]
+    assert wire.decode_responses(wire.encode_responses(responses)) == responses
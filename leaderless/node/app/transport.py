@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from cluster import ADDRESSES
+
+CONNECT_TIMEOUT = float(os.environ.get("PEER_CONNECT_TIMEOUT", 0.5))
+READ_TIMEOUT = float(os.environ.get("PEER_READ_TIMEOUT", 5))
+POOL_SIZE = int(os.environ.get("PEER_POOL_SIZE", 16))
+# Requests an outbox keeps in flight to its peer and the maximum number of messages coalesced into one of them.
+OUTBOX_SENDERS = int(os.environ.get("PEER_OUTBOX_SENDERS", 4))
+OUTBOX_MAX_MESSAGES = int(os.environ.get("PEER_OUTBOX_MAX_MESSAGES", 64))
+
+
+class Peer:
+    """
+    Persistent keep-alive HTTP client for a single peer node.
+    """
+
+    def __init__(self, id: int):
+        self.id = id
+        self.address = ADDRESSES[id]
+        self.url = f"http://{self.address}"
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=False, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+
+        self.lock = threading.Lock()
+        self.outboxes = {}
+        self.requests_cnt = 0
+        self.failures_cnt = 0
+        self.total_latency = 0.0
+        self.last_error = None
+        # time.monotonic() of the last successful request, used by the failure detector.
+        self.last_success = float("-inf")
+
+    def record(self, latency: float, error: Exception = None):
+        with self.lock:
+            self.requests_cnt += 1
+            self.total_latency += latency
+            if error is not None:
+                self.failures_cnt += 1
+                self.last_error = str(error)
+            else:
+                self.last_success = time.monotonic()
+
+    def get(self, endpoint: str) -> dict:
+        """
+        Sends a GET request and returns the decoded JSON response. Raises like put.
+        """
+        start = time.monotonic()
+        try:
+            r = self.session.get(f"{self.url}/{endpoint}", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            r.raise_for_status()
+            res = r.json()
+        except Exception as error:
+            self.record(time.monotonic() - start, error)
+            raise
+        self.record(time.monotonic() - start)
+        return res
+
+    def put(self, endpoint: str, body: dict, read_timeout: float = READ_TIMEOUT) -> dict:
+        """
+        Sends a PUT request with a JSON body and returns the decoded response.
+        Raises on connection errors, timeouts and non 2xx responses.
+        """
+        start = time.monotonic()
+        try:
+            r = self.session.put(f"{self.url}/{endpoint}", json=body, timeout=(CONNECT_TIMEOUT, read_timeout))
+            r.raise_for_status()
+            res = r.json()
+        except Exception as error:
+            self.record(time.monotonic() - start, error)
+            raise
+        self.record(time.monotonic() - start)
+        return res
+
+    def put_bytes(self, endpoint: str, data: bytes) -> bytes:
+        """
+        Sends a PUT request with a binary body and returns the binary response.
+        Raises on connection errors, timeouts and non 2xx responses.
+        """
+        start = time.monotonic()
+        try:
+            r = self.session.put(f"{self.url}/{endpoint}", data=data, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                                 headers={"Content-Type": "application/octet-stream"})
+            r.raise_for_status()
+            res = r.content
+        except Exception as error:
+            self.record(time.monotonic() - start, error)
+            raise
+        self.record(time.monotonic() - start)
+        return res
+
+    def move(self, address: str):
+        """
+        Sends later requests to the node's new address, e.g. one set by a reconfiguration.
+        """
+        with self.lock:
+            self.address = address
+            self.url = f"http://{address}"
+            # The node was not heard from at its new address yet.
+            self.last_success = float("-inf")
+        self.adapter.close()
+
+    def outbox(self, endpoint: str, encode, decode) -> "Outbox":
+        with self.lock:
+            if endpoint not in self.outboxes:
+                self.outboxes[endpoint] = Outbox(self, endpoint, encode, decode)
+            return self.outboxes[endpoint]
+
+    def stream(self, endpoint: str, params: dict):
+        """
+        Sends a GET request and yields the decoded lines of a newline delimited JSON response as they arrive.
+        The read timeout applies to every chunk, not to the whole response.
+        """
+        start = time.monotonic()
+        try:
+            with self.session.get(f"{self.url}/{endpoint}", params=params, stream=True,
+                                  timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        except Exception as error:
+            self.record(time.monotonic() - start, error)
+            raise
+        self.record(time.monotonic() - start)
+
+    def stats(self) -> dict:
+        pools = self.adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        with self.lock:
+            return {
+                "requests": self.requests_cnt,
+                "failures": self.failures_cnt,
+                "avg_latency_ms": 1000 * self.total_latency / self.requests_cnt if self.requests_cnt else None,
+                "connections_opened": sum(pool.num_connections for pool in pools),
+                "idle_connections": sum(1 for pool in pools if pool.pool for conn in list(pool.pool.queue) if conn),
+                "last_error": self.last_error,
+            }
+
+
+class Outbox:
+    """
+    Coalesces messages to a single endpoint of a peer: every request carries all messages queued while
+    earlier requests were in flight. encode(messages) builds the request body and decode(body) returns
+    the list of replies, in the order of the messages.
+    """
+
+    def __init__(self, peer: Peer, endpoint: str, encode, decode):
+        self.peer = peer
+        self.endpoint = endpoint
+        self.encode = encode
+        self.decode = decode
+        self.cond = threading.Condition()
+        self.pending = []
+        for i in range(OUTBOX_SENDERS):
+            threading.Thread(target=self.sender, name=f"outbox-{peer.id}-{i}", daemon=True).start()
+
+    def submit(self, message) -> Future:
+        """
+        Queues the message. The returned future resolves to its reply or to the error of the request carrying it.
+        """
+        future = Future()
+        with self.cond:
+            self.pending.append((message, future))
+            self.cond.notify()
+        return future
+
+    def sender(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch = self.pending[:OUTBOX_MAX_MESSAGES]
+                del self.pending[:OUTBOX_MAX_MESSAGES]
+
+            try:
+                responses = self.decode(self.peer.put_bytes(self.endpoint, self.encode([m for m, _ in batch])))
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), r in zip(batch, responses):
+                future.set_result(r)
+
+
+def not_delivered(error: Exception) -> bool:
+    """
+    Whether the request failed before a connection to the peer was established, so the peer
+    cannot have seen it.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    return isinstance(error, requests.ConnectionError) and bool(error.args) \
+        and isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+
+
+peers = {}
+peers_lock = threading.Lock()
+
+
+def get_peer(id: int) -> Peer:
+    with peers_lock:
+        if id not in peers:
+            peers[id] = Peer(id)
+        elif peers[id].address != ADDRESSES[id]:
+            peers[id].move(ADDRESSES[id])
+        return peers[id]
+
+
+def stats() -> dict:
+    with peers_lock:
+        return {id: peer.stats() for id, peer in peers.items()}
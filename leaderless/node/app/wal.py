@@ -0,0 +1,143 @@
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+# Every record is framed as <payload length><crc32 of payload><pickled payload>.
+HEADER = struct.Struct("!II")
+
+
+class WriteAheadLog:
+    """
+    Durable append-only log of records with periodic snapshots.
+    A snapshot holds the whole state, the log holds every record appended since the last snapshot.
+    """
+
+    def __init__(self, name: str, snapshot_every: int, group_commit_delay: float = 0):
+        self.log_path = f"{name}.wal"
+        self.snapshot_path = f"{name}.snapshot"
+        self.snapshot_every = snapshot_every
+        self.records_since_snapshot = 0
+        self.file = None
+
+        # Group commit: records are numbered as they are written and a single fsync makes every
+        # record written before it durable. The thread that starts an fsync waits group_commit_delay
+        # seconds first, so that records of concurrent requests join the same write.
+        self.group_commit_delay = group_commit_delay
+        self.cond = threading.Condition()
+        self.written_seq = 0
+        self.durable_seq = 0
+        self.syncing = False
+
+    def recover(self):
+        """
+        Returns the last snapshot (or None) and the records appended after it.
+        A torn or corrupted tail left by a crash in the middle of an append is cut off.
+        """
+        snapshot = None
+        try:
+            with open(self.snapshot_path, "rb") as infile:
+                snapshot = pickle.load(infile)
+        except FileNotFoundError:
+            pass
+
+        records = []
+        valid_length = 0
+        try:
+            with open(self.log_path, "rb") as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            data = b""
+
+        while valid_length + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, valid_length)
+            payload = data[valid_length + HEADER.size:valid_length + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records.append(pickle.loads(payload))
+            valid_length += HEADER.size + length
+
+        self.file = open(self.log_path, "ab")
+        if valid_length < len(data):
+            self.file.truncate(valid_length)
+            self.sync()
+        self.records_since_snapshot = len(records)
+        return snapshot, records
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, record) -> int:
+        """
+        Appends the record without waiting for the disk and returns its sequence number.
+        """
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.cond:
+            self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.records_since_snapshot += 1
+            self.written_seq += 1
+            return self.written_seq
+
+    def wait_durable(self, seq: int):
+        """
+        Returns once the record with the given sequence number, and every record before it, is on disk.
+        """
+        with self.cond:
+            while self.durable_seq < seq:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+
+                self.syncing = True
+                if self.group_commit_delay > 0:
+                    self.cond.wait(self.group_commit_delay)
+                target_seq = self.written_seq
+                self.file.flush()
+                self.cond.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.durable_seq = max(self.durable_seq, target_seq)
+
+    def should_snapshot(self) -> bool:
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, state):
+        """
+        Durably replaces the snapshot with state and truncates the log.
+        State must include the effect of every record appended so far.
+        """
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            self.write_snapshot(state)
+            self.durable_seq = self.written_seq
+            self.cond.notify_all()
+
+    def write_snapshot(self, state):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        sync_directory(self.snapshot_path)
+
+        # Crashing before the truncation is safe, replaying records on top of the snapshot is idempotent.
+        self.file.flush()
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+        self.records_since_snapshot = 0
+
+
+def sync_directory(path: str):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,219 @@
+import struct
+
+import bank as bank
+
+# Binary encoding of acceptor messages exchanged through /acceptor_batch. A request body is a list of
+# messages and the response body the list of their replies, in the same order. Every message and reply
+# starts with its kind, followed by fixed-size fields; batches, strings and lists are length prefixed.
+# An operation is OP, its request id and its arguments.
+PREPARE = 1
+ACCEPT = 2
+READ_INDEX = 3
+APPLIED = 4
+
+PROMISE = 1
+NACK = 2
+RANGE_PROMISE = 3
+ACCEPTED = 4
+RUN_ID = 5
+ACK = 6
+
+COUNT = struct.Struct("!I")
+KIND = struct.Struct("!B")
+# group, run_id, propose_id, node_id, applied_run_id. Missing node ids and run ids are sent as -1.
+HEADER = struct.Struct("!Hqqiq")
+PREPARE_FLAGS = struct.Struct("!?")
+# group, node_id, applied_run_id of READ_INDEX and APPLIED messages.
+READ_INDEX_HEADER = struct.Struct("!Hiq")
+OP = struct.Struct("!iBB")
+STRING = struct.Struct("!H")
+INT = struct.Struct("!q")
+# promised_id and the node using it, -1 if unknown.
+NACK_FIELDS = struct.Struct("!qi")
+RANGE_ENTRY = struct.Struct("!qq")
+BOOL = struct.Struct("!?")
+
+INT_ARG = 0
+STR_ARG = 1
+
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt: struct.Struct) -> tuple:
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read_one(self, fmt: struct.Struct):
+        return self.read(fmt)[0]
+
+    def read_string(self) -> str:
+        length = self.read_one(STRING)
+        value = self.data[self.offset:self.offset + length].decode()
+        self.offset += length
+        return value
+
+
+def optional(value) -> int:
+    return -1 if value is None else value
+
+
+def required(value: int):
+    return None if value == -1 else value
+
+
+def encode_string(out: list, value: str):
+    data = value.encode()
+    out.append(STRING.pack(len(data)))
+    out.append(data)
+
+
+def encode_batch(out: list, batch):
+    """
+    Appends the batch, or an empty marker if it is None. batch may also be a dict decoded from JSON.
+    """
+    if batch is None:
+        out.append(BOOL.pack(False))
+        return
+    batch = bank.as_batch(batch)
+    out.append(BOOL.pack(True))
+    out.append(COUNT.pack(len(batch.ops)))
+    for op in batch.ops:
+        out.append(OP.pack(int(op.node_id), int(op.op_type), len(op.args)))
+        encode_string(out, op.request_id)
+        for key, value in op.args.items():
+            encode_string(out, key)
+            if isinstance(value, int):
+                out.append(KIND.pack(INT_ARG))
+                out.append(INT.pack(value))
+            else:
+                out.append(KIND.pack(STR_ARG))
+                encode_string(out, str(value))
+
+
+def decode_batch(reader: Reader) -> bank.BankBatch:
+    if not reader.read_one(BOOL):
+        return None
+    ops = []
+    for _ in range(reader.read_one(COUNT)):
+        node_id, op_type, args_cnt = reader.read(OP)
+        request_id = reader.read_string()
+        args = {}
+        for _ in range(args_cnt):
+            key = reader.read_string()
+            if reader.read_one(KIND) == INT_ARG:
+                args[key] = reader.read_one(INT)
+            else:
+                args[key] = reader.read_string()
+        ops.append(bank.BankOperation(op_type=bank.BankOpType(op_type), args=args, node_id=node_id,
+                                      request_id=request_id))
+    return bank.BankBatch(ops=ops)
+
+
+def encode_requests(messages: list) -> bytes:
+    """
+    Encodes messages given as tuples:
+    (PREPARE, group, run_id, propose_id, range_prepare, node_id, applied_run_id),
+    (ACCEPT, group, run_id, propose_id, val, node_id, applied_run_id),
+    (READ_INDEX, group, node_id, applied_run_id) and (APPLIED, group, node_id, applied_run_id).
+    """
+    out = [COUNT.pack(len(messages))]
+    for message in messages:
+        kind = message[0]
+        out.append(KIND.pack(kind))
+        if kind in (READ_INDEX, APPLIED):
+            _, group, node_id, applied_run_id = message
+            out.append(READ_INDEX_HEADER.pack(group, optional(node_id), optional(applied_run_id)))
+            continue
+
+        _, group, run_id, propose_id, payload, node_id, applied_run_id = message
+        out.append(HEADER.pack(group, run_id, propose_id, optional(node_id), optional(applied_run_id)))
+        if kind == PREPARE:
+            out.append(PREPARE_FLAGS.pack(payload))
+        elif kind == ACCEPT:
+            encode_batch(out, payload)
+        else:
+            raise ValueError(f"Unrecognised message {message}!")
+    return b"".join(out)
+
+
+def decode_requests(data: bytes) -> list:
+    reader = Reader(data)
+    messages = []
+    for _ in range(reader.read_one(COUNT)):
+        kind = reader.read_one(KIND)
+        if kind in (READ_INDEX, APPLIED):
+            group, node_id, applied_run_id = reader.read(READ_INDEX_HEADER)
+            messages.append((kind, group, required(node_id), required(applied_run_id)))
+            continue
+
+        group, run_id, propose_id, node_id, applied_run_id = reader.read(HEADER)
+        if kind == PREPARE:
+            payload = reader.read_one(PREPARE_FLAGS)
+        elif kind == ACCEPT:
+            payload = decode_batch(reader)
+        else:
+            raise ValueError(f"Unrecognised message kind {kind}!")
+        messages.append((kind, group, run_id, propose_id, payload, required(node_id), required(applied_run_id)))
+    return messages
+
+
+def encode_responses(responses: list) -> bytes:
+    """
+    Encodes replies in the format returned by the acceptor handlers.
+    """
+    out = [COUNT.pack(len(responses))]
+    for r in responses:
+        if not r:
+            out.append(KIND.pack(ACK))
+        elif "promised_id" in r:
+            out.append(KIND.pack(NACK))
+            out.append(NACK_FIELDS.pack(r["promised_id"], optional(r.get("promised_by"))))
+        elif "accepted_id" in r:
+            out.append(KIND.pack(PROMISE))
+            out.append(INT.pack(r["accepted_id"]))
+            encode_batch(out, r["accepted_val"])
+        elif "run_id" in r:
+            out.append(KIND.pack(RUN_ID))
+            out.append(INT.pack(r["run_id"]))
+        elif isinstance(r["accepted"], bool):
+            out.append(KIND.pack(ACCEPTED))
+            out.append(BOOL.pack(r["accepted"]))
+        else:
+            out.append(KIND.pack(RANGE_PROMISE))
+            out.append(COUNT.pack(len(r["accepted"])))
+            for a in r["accepted"]:
+                out.append(RANGE_ENTRY.pack(a["run_id"], a["accepted_id"]))
+                encode_batch(out, a["accepted_val"])
+    return b"".join(out)
+
+
+def decode_responses(data: bytes) -> list:
+    reader = Reader(data)
+    responses = []
+    for _ in range(reader.read_one(COUNT)):
+        kind = reader.read_one(KIND)
+        if kind == NACK:
+            promised_id, promised_by = reader.read(NACK_FIELDS)
+            responses.append({"promised_id": promised_id, "promised_by": required(promised_by)})
+        elif kind == PROMISE:
+            accepted_id = reader.read_one(INT)
+            responses.append({"accepted_id": accepted_id, "accepted_val": decode_batch(reader)})
+        elif kind == RUN_ID:
+            responses.append({"run_id": reader.read_one(INT)})
+        elif kind == ACCEPTED:
+            responses.append({"accepted": reader.read_one(BOOL)})
+        elif kind == ACK:
+            responses.append({})
+        elif kind == RANGE_PROMISE:
+            accepted = []
+            for _ in range(reader.read_one(COUNT)):
+                run_id, accepted_id = reader.read(RANGE_ENTRY)
+                accepted.append({"run_id": run_id, "accepted_id": accepted_id, "accepted_val": decode_batch(reader)})
+            responses.append({"accepted": accepted})
+        else:
+            raise ValueError(f"Unrecognised reply kind {kind}!")
+    return responses
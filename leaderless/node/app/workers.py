@@ -0,0 +1,25 @@
+from anyio import CapacityLimiter, to_thread
+from anyio.lowlevel import RunVar
+
+
+class ThreadLimiter:
+    """
+    Bounds the number of worker threads running one class of blocking request handlers,
+    so that a class waiting on the network or the disk cannot take the threads of another.
+    The CapacityLimiter is created in the running event loop on first use.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.var = RunVar(name)
+        self.size = size
+
+    def get(self) -> CapacityLimiter:
+        try:
+            return self.var.get()
+        except LookupError:
+            limiter = CapacityLimiter(self.size)
+            self.var.set(limiter)
+            return limiter
+
+    async def run(self, func, *args):
+        return await to_thread.run_sync(func, *args, limiter=self.get())
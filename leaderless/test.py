@@ -92,7 +92,7 @@ def get_state(node_port):
     node_state = {}
     for id in accounts.keys():
         print(f"Reading balance of account {id}.")
-        r = requests.put(f'{LOCALHOST}:{node_port}/deposit', json={"id": id, "amount": 0})
+        r = requests.get(f'{LOCALHOST}:{node_port}/balance/{id}')
         print(r)
         if r.status_code == 200:
             node_state[id] = r.json()["balance"]